@@ -1,28 +1,274 @@
 import anthropic # api call
+import asyncio
 import pdfplumber as pdf # text extraction
 import subprocess # allows terminal commmands to run in a python script
 import time
+import os
+import hashlib # content-addressed text cache
+import tempfile
+import json
+import math
+import re
+import random
+import threading
+import collections
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait # parallel page extraction, candidate races
+
+from store import STORE # caches shared across worker processes
+from lint import diagnostic, lint_zen, format_diagnostics # catches clearly broken output before pcb build
+from workers import BuildWorkers # warm pcb workspaces
+import metrics
+
+log = logging.getLogger(__name__)
+
+PDF_PAGE_LIMIT = 78
+# how many processes to split the pdf pages across, 1 keeps it serial
+PDF_WORKERS = int(os.environ.get('TRACE_PDF_WORKERS', '1'))
+# extracted text gets cached on disk by the sha256 of the pdf bytes, oldest-used files get evicted past the size cap
+TEXT_CACHE_DIR = os.environ.get('TRACE_TEXT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'trace_text_cache'))
+TEXT_CACHE_MAX_BYTES = int(os.environ.get('TRACE_TEXT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# a .tmp in the cache older than this is from a write that died (killed worker), not one still going
+TEXT_CACHE_TMP_MAX_AGE = 3600
+# how many tokens of datasheet pages we send to the model, 0 falls back to the first PDF_PAGE_LIMIT pages
+PAGE_TOKEN_BUDGET = int(os.environ.get('TRACE_PAGE_TOKEN_BUDGET', '40000'))
+# what a page needs to talk about to be worth sending, with a weight per term
+PAGE_QUERY_TERMS = {
+    'pin': 3.0, 'pins': 3.0, 'pinout': 3.0, 'configuration': 1.5, 'description': 1.0,
+    'absolute': 2.5, 'maximum': 2.0, 'ratings': 2.5, 'recommended': 1.5, 'operating': 1.5,
+    'typical': 2.0, 'application': 2.0, 'circuit': 2.0, 'schematic': 2.0, 'reference': 1.0,
+    'decoupling': 2.0, 'bypass': 1.5, 'capacitor': 1.5, 'power': 1.5, 'supply': 1.5,
+    'vdd': 1.5, 'vcc': 1.5, 'gnd': 1.5, 'voltage': 1.0, 'electrical': 1.0, 'characteristics': 1.0,
+    'package': 1.5, 'footprint': 1.5, 'gpio': 1.0, 'reset': 1.0, 'enable': 1.0,
+    'i2c': 1.0, 'spi': 1.0, 'uart': 1.0, 'usb': 1.0,
+}
+# retries patch the previous module with just the diagnostics instead of resending the whole datasheet
+REPAIR_MODE = os.environ.get('TRACE_REPAIR_MODE', '1') == '1'
+# max number of pcb builds running at once in this process
+BUILD_CONCURRENCY = int(os.environ.get('TRACE_BUILD_CONCURRENCY', '4'))
+BUILD_SLOTS = threading.BoundedSemaphore(BUILD_CONCURRENCY)
+# workspaces kept warm for pcb build (see workers.py), 0 gives every build a fresh temp dir
+BUILD_WORKERS = BuildWorkers(int(os.environ.get('TRACE_BUILD_WORKERS', str(BUILD_CONCURRENCY))))
+# (success, stderr) per normalized source + pcb version, so identical modules skip pcb build.
+# lives in the shared store so every worker benefits, the hit/miss counts are per process
+BUILD_CACHE_SIZE = int(os.environ.get('TRACE_BUILD_CACHE_SIZE', '512'))
+# a failed build can be pcb's fault (a package fetch that timed out), so failures are only kept this long. 0 skips them
+BUILD_FAILURE_TTL = float(os.environ.get('TRACE_BUILD_FAILURE_TTL', '300'))
+BUILD_CACHE_LOCK = threading.Lock()
+BUILD_CACHE_STATS = {'hits': 0, 'misses': 0}
+# lint every module before building it, clearly broken ones never reach pcb (see lint.py)
+LINT_BEFORE_BUILD = os.environ.get('TRACE_LINT', '1') == '1'
+# retry delay policy, see backoff_delay
+BACKOFF_BASE = float(os.environ.get('TRACE_BACKOFF_BASE', '2'))
+BACKOFF_MAX = float(os.environ.get('TRACE_BACKOFF_MAX', '60'))
+# speculative mode: every attempt asks for this many candidates at once and keeps the first that compiles
+# (see race_candidates). 1 is the plain sequential loop
+SPECULATIVE_CANDIDATES = int(os.environ.get('TRACE_SPECULATIVE_CANDIDATES', '1'))
+# candidate i gets temperature i (cycling), candidate 0 is what the sequential loop would have sent
+CANDIDATE_TEMPERATURES = (1.0, 0.3, 0.7, 0.5, 0.9, 0.1)
+SPECULATION_LOCK = threading.Lock()
+SPECULATION_STATS = {'races': 0, 'wins': 0, 'saved_seconds': 0.0, 'extra_output_tokens': 0}
+# how many parsed build diagnostics go back to the model (and into /generate failures), and how many
+# characters of messages at most. see parse_diagnostics
+DIAGNOSTICS_LIMIT = int(os.environ.get('TRACE_DIAGNOSTICS_LIMIT', '20'))
+DIAGNOSTICS_MAX_CHARS = int(os.environ.get('TRACE_DIAGNOSTICS_MAX_CHARS', '4000'))
+# model tiers as "model:attempts,...": the first attempt goes to the cheap model and build failures move the run
+# up a tier once a tier's attempts are used (the last tier takes whatever's left). see tier_model
+ZENER_TIERS = os.environ.get('TRACE_ZENER_TIERS', 'claude-haiku-4-5:1,claude-sonnet-4-6')
+TIER_LOCK = threading.Lock()
+TIER_STATS = {}
+
+
+# pulls the text out of pages [start, stop), one string per page
+# lives at module level so the process pool can pickle it
+def _extract_page_range(path, start, stop):
+    with pdf.open(path) as f:
+        return [page.extract_text() or "" for page in f.pages[start:stop]]
 
-# First, we need to extract all the text from the pdf of the datasheet 
-def extract_pdf(path): # takes in the path to the pdf 
-    text = ''
-    # run iteratively over each page and add and return cumulatively collected text
+
+# returns the text of each page in page order, either serially or sharded across a process pool
+def extract_pages(path, limit=PDF_PAGE_LIMIT, workers=None):
+    workers = PDF_WORKERS if workers is None else workers
     with pdf.open(path) as f:
-        for page in f.pages[:78]:
-            text += page.extract_text() or ""
-    return text 
+        count = len(f.pages) if limit is None else min(len(f.pages), limit)
+        if workers <= 1 or count < 2:
+            return [page.extract_text() or "" for page in f.pages[:count]]
 
+    # every worker opens its own copy of the pdf and handles one contiguous chunk of pages
+    chunk = -(-count // min(workers, count))
+    starts = list(range(0, count, chunk))
+    stops = [min(start + chunk, count) for start in starts]
+    with ProcessPoolExecutor(max_workers=len(starts)) as pool:
+        shards = pool.map(_extract_page_range, [path] * len(starts), starts, stops)
+        return [text for shard in shards for text in shard]
 
-# Next, Generate Zener Code
-def generate_zener(client, datasheet_text, errors=None):
-    prompt = datasheet_text
-    if errors:
-        prompt += f'\n\nPrevious attempt failed with these errors:\n{errors}\nFix them.'
-    
-    message = client.messages.create(
-        model = 'claude-sonnet-4-6',
-        max_tokens = 5000,
-        system = """
+
+# First, we need to extract all the text from the pdf of the datasheet 
+def extract_pdf(path, workers=None): # takes in the path to the pdf 
+    # pool.map keeps the shards in order so this matches the serial output exactly
+    return ''.join(extract_pages(path, workers=workers))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# drops the least recently used entries (oldest mtime) until the cache fits under the size cap, plus temp files
+# from writes that never finished. every gunicorn worker evicts, so files can vanish while we look at them
+def _evict_text_cache(cache_dir, max_bytes):
+    entries = []
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.tmp') and now - stat.st_mtime > TEXT_CACHE_TMP_MAX_AGE:
+            _unlink(entry.path)
+        elif entry.name.endswith('.json'):
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        _unlink(path)
+        total -= size
+
+
+# same as extract_pages over the whole pdf, but a datasheet we've already seen skips pdfplumber completely
+def cached_extract_pages(path, workers=None, cache_dir=None, max_bytes=None):
+    cache_dir = cache_dir or TEXT_CACHE_DIR
+    max_bytes = TEXT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, file_sha256(path) + '.json')
+
+    try:
+        with open(entry, encoding='utf-8') as f:
+            pages = json.load(f)
+        os.utime(entry) # bump it so LRU eviction sees it as recently used
+        return pages
+    except (FileNotFoundError, ValueError):
+        pass
+
+    pages = extract_pages(path, limit=None, workers=workers)
+    # write to a temp file and rename so another worker never reads half an entry
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(pages, f)
+        os.replace(tmp_path, entry)
+    except BaseException:
+        _unlink(tmp_path)
+        raise
+    _evict_text_cache(cache_dir, max_bytes)
+    return pages
+
+
+# rough token count, close enough for budgeting prompt size
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+def _tokenize(text):
+    return re.findall(r'[a-z0-9_]+', text.lower())
+
+
+# ranks every page with BM25 against the sections we actually need to write a module
+# (pinouts, ratings, application circuits) and keeps the best ones that fit in the token budget.
+# page 1 always goes in since it has the part number and overview. returns 0-based page indexes in page order
+def select_pages(pages, token_budget=None, k1=1.5, b=0.75):
+    token_budget = PAGE_TOKEN_BUDGET if token_budget is None else token_budget
+    if not pages:
+        return []
+    if token_budget <= 0:
+        return list(range(min(len(pages), PDF_PAGE_LIMIT)))
+
+    docs = [_tokenize(page) for page in pages]
+    avg_len = (sum(len(doc) for doc in docs) / len(docs)) or 1
+    doc_freq = {}
+    for doc in docs:
+        for term in set(doc):
+            doc_freq[term] = doc_freq.get(term, 0) + 1
+
+    scores = []
+    for doc in docs:
+        counts = {}
+        for term in doc:
+            counts[term] = counts.get(term, 0) + 1
+        score = 0.0
+        for term, weight in PAGE_QUERY_TERMS.items():
+            tf = counts.get(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += weight * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avg_len))
+        scores.append(score)
+
+    selected = [0]
+    used = estimate_tokens(pages[0])
+    for index in sorted(range(1, len(pages)), key=lambda i: (-scores[i], i)):
+        if scores[index] <= 0:
+            break
+        cost = estimate_tokens(pages[index])
+        if used + cost > token_budget:
+            continue
+        selected.append(index)
+        used += cost
+    return sorted(selected)
+
+
+# extraction + page selection in one go. returns the prompt text and the 1-based page numbers that made it in
+def load_datasheet(path, workers=None, token_budget=None):
+    with metrics.timed('trace_stage_seconds', stage='extract'):
+        pages = cached_extract_pages(path, workers=workers)
+    with metrics.timed('trace_stage_seconds', stage='select_pages'):
+        selected = select_pages(pages, token_budget)
+    return ''.join(pages[i] for i in selected), [i + 1 for i in selected]
+
+
+# adds a response's input/output tokens to totals (a dict), for callers that want a run's token count.
+# speculative candidates add to the same dict from their own threads, a loser can even finish after the race
+USAGE_LOCK = threading.Lock()
+
+
+def add_usage(totals, message):
+    usage = getattr(message, 'usage', None)
+    if totals is None or usage is None:
+        return
+    with USAGE_LOCK:
+        for field in ('input_tokens', 'output_tokens'):
+            totals[field] = totals.get(field, 0) + (getattr(usage, field, 0) or 0)
+
+
+# logs token usage for a response, including how much of the prompt came from / went into the prompt cache
+def log_usage(message, endpoint='generate'):
+    metrics.record_usage(message, endpoint)
+    usage = getattr(message, 'usage', None)
+    if usage is None:
+        return
+    log.info(
+        'tokens in=%s out=%s cache_read=%s cache_write=%s',
+        usage.input_tokens, usage.output_tokens,
+        getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+    )
+
+
+# the full Zener language spec we hand the model as its system prompt
+ZENER_SPEC = """
         You are an excellent electrical engineeer that can write really good Zener hardware description code.  Given a component datasheet, output a valid .zen module file that correctly describes the component.
         Given a component datasheet, output a valid .zen module file that correctly describes the component.
         Here is the complete Zener specification you must follow exactly:
@@ -806,56 +1052,738 @@ def generate_zener(client, datasheet_text, errors=None):
 
 voltage=None`** —- Always use explicit voltage values, never None. For ESP32 use Voltage("3.3V")
 - Power() always requires a voltage: Power("VDD3P3", voltage=Voltage("3.3V"))
-    """,
+    """
+
+
+# compiler noise we don't want to treat as datasheet identifiers when looking for excerpts
+_DIAGNOSTIC_STOPWORDS = {'ERROR', 'WARNING', 'NOTE', 'HELP', 'ZEN', 'PCB', 'NONE', 'TRUE', 'FALSE'}
+
+
+# keeps the lines of the compiler output that actually say something, without repeats
+def diagnostic_lines(errors, limit=20):
+    lines = []
+    for line in (errors or '').splitlines():
+        line = line.strip()
+        if line and line not in lines:
+            lines.append(line)
+    flagged = [line for line in lines if re.search(r'error|warning|-->|\bat\b', line, re.IGNORECASE)]
+    return (flagged or lines)[:limit]
+
+
+# "error[code]: message" / "warning: message", with the location on a following "--> file:line:col" line
+_DIAGNOSTIC_HEADER = re.compile(r'^(?:[×✗]\s*)?(error|warning|note|help)(?:\[([\w.-]+)\])?\s*:\s*(.*)$', re.IGNORECASE)
+_DIAGNOSTIC_LOCATION = re.compile(r'^(?:-->|╭─\[|at\b)\s*([^\s:\]]+):(\d+)(?::(\d+))?')
+# "file.zen:line:col: error: message" all on one line
+_DIAGNOSTIC_INLINE = re.compile(r'^([^\s:]+\.zen):(\d+)(?::(\d+))?:\s*(error|warning)(?:\[([\w.-]+)\])?\s*:\s*(.*)$',
+                                re.IGNORECASE)
+# failed builds per diagnostic_class in this process, the top few get logged
+DIAGNOSTIC_LOCK = threading.Lock()
+DIAGNOSTIC_CLASSES = collections.Counter()
+# how many distinct kinds get a trace_diagnostics_total series per process, compiler text is open ended
+DIAGNOSTIC_KINDS = int(os.environ.get('TRACE_DIAGNOSTIC_KINDS', '20'))
+METRIC_KINDS = set()
+
+
+# pcb build output (or lint output, same shape) as diagnostic records like lint.py's: file, line, col, severity,
+# code and message. note / help lines get folded into the diagnostic they belong to, repeats are dropped,
+# errors come before warnings and the list stops at limit records / max_chars of messages.
+# output with nothing that looks like a diagnostic becomes one error per meaningful line
+def parse_diagnostics(output, limit=None, max_chars=None):
+    limit = DIAGNOSTICS_LIMIT if limit is None else limit
+    max_chars = DIAGNOSTICS_MAX_CHARS if max_chars is None else max_chars
+    found = []  # (record, notes)
+    for line in (output or '').splitlines():
+        line = line.strip()
+        inline = _DIAGNOSTIC_INLINE.match(line)
+        header = _DIAGNOSTIC_HEADER.match(line.lstrip('= '))
+        location = _DIAGNOSTIC_LOCATION.match(line)
+        if inline:
+            filename, row, col, severity, code, message = inline.groups()
+            found.append((diagnostic(filename, int(row), int(col) if col else None, code, message, severity.lower()), []))
+        elif header and header.group(1).lower() in ('error', 'warning'):
+            severity, code, message = header.groups()
+            found.append((diagnostic(None, None, None, code, message, severity.lower()), []))
+        elif header and found and header.group(3):
+            found[-1][1].append(f'{header.group(1).lower()}: {header.group(3)}')
+        elif location and found and found[-1][0]['file'] is None:
+            col = location.group(3)
+            found[-1][0].update(file=location.group(1), line=int(location.group(2)), col=int(col) if col else None)
+    if not found:
+        found = [(diagnostic(None, None, None, None, line), []) for line in diagnostic_lines(output, limit)]
+
+    # repeats are compared without their notes, the first one that had notes keeps them
+    unique = []
+    notes = []
+    for record, record_notes in found:
+        if record in unique:
+            index = unique.index(record)
+            notes[index] = notes[index] or record_notes
+            continue
+        unique.append(record)
+        notes.append(record_notes)
+    for record, record_notes in zip(unique, notes):
+        if record_notes:
+            record['message'] += ' (' + '; '.join(record_notes) + ')'
+    unique.sort(key=lambda record: record['severity'] != 'error')
+    kept = []
+    size = 0
+    for record in unique[:limit]:
+        size += len(record['message'])
+        if kept and size > max_chars:
+            break
+        kept.append(record)
+    return kept
+
+
+# one diagnostic as a single line: "output.zen:12:5: error[code]: message"
+def diagnostic_line(record):
+    location = ':'.join(str(part) for part in (record['file'], record['line'], record['col']) if part is not None)
+    code = f"[{record['code']}]" if record['code'] else ''
+    return f"{location + ': ' if location else ''}{record['severity']}{code}: {record['message']}"
+
+
+# what a diagnostic is about with the specifics (names, pins, numbers) taken out, so failures can be counted
+# by kind: 'unknown pin "GPIO45" in Component U1' -> 'unknown pin _ in Component _'
+def diagnostic_class(record):
+    if record['code']:
+        return record['code']
+    message = re.sub(r' \((?:note|help): .*\)$', '', record['message'])
+    # unbalanced quotes and backslashes are left over from the substitution, they're just noise in a kind
+    message = re.sub(r'"[^"]*"|\'[^\']*\'|`[^`]*`|\b\w*\d\w*\b', '_', message)
+    return re.sub(r'["\\\s]+', ' ', message).strip()[:60]
+
+
+def record_diagnostics(diagnostics):
+    classes = [diagnostic_class(record) for record in diagnostics if record['severity'] == 'error']
+    with DIAGNOSTIC_LOCK:
+        DIAGNOSTIC_CLASSES.update(classes)
+        common = DIAGNOSTIC_CLASSES.most_common(5)
+        # the first DIAGNOSTIC_KINDS kinds this process sees get their own series, the rest count as 'other'
+        labels = []
+        for kind in classes:
+            if kind not in METRIC_KINDS and len(METRIC_KINDS) < DIAGNOSTIC_KINDS:
+                METRIC_KINDS.add(kind)
+            labels.append(kind if kind in METRIC_KINDS else 'other')
+    for kind in labels:
+        metrics.inc('trace_diagnostics_total', kind=kind)
+    log.info('build failed with %s, most common so far %s', classes, common)
+
+
+# pulls the datasheet lines that mention whatever names the diagnostics complain about (pins, nets, parts)
+def datasheet_excerpts(datasheet_text, diagnostics, max_chars=6000):
+    terms = []
+    for line in diagnostics:
+        for term in re.findall(r'["\'`]([^"\'`]{2,40})["\'`]|\b([A-Z][A-Z0-9_]{2,})\b', line):
+            term = term[0] or term[1]
+            if term.upper() not in _DIAGNOSTIC_STOPWORDS and term not in terms:
+                terms.append(term)
+
+    lines = datasheet_text.splitlines()
+    picked = []
+    size = 0
+    for term in terms:
+        for i, line in enumerate(lines):
+            if term not in line:
+                continue
+            excerpt = '\n'.join(lines[max(i - 1, 0):i + 2])
+            if excerpt in picked:
+                continue
+            if size + len(excerpt) > max_chars:
+                return '\n...\n'.join(picked)
+            picked.append(excerpt)
+            size += len(excerpt)
+    return '\n...\n'.join(picked)
+
+
+# a retry that patches the previous module instead of starting over from the whole datasheet
+def repair_prompt(datasheet_text, previous_code, errors):
+    diagnostics = [diagnostic_line(record) for record in parse_diagnostics(errors)]
+    prompt = f'This .zen module failed to compile:\n\n{previous_code}\n\nCompiler diagnostics:\n'
+    prompt += '\n'.join(f'- {line}' for line in diagnostics)
+    excerpts = datasheet_excerpts(datasheet_text, diagnostics)
+    if excerpts:
+        prompt += f'\n\nRelevant datasheet excerpts:\n{excerpts}'
+    prompt += '\n\nFix only what the diagnostics point at and output the complete corrected module.'
+    return prompt
+
+
+# how often each kind of attempt ends up compiling, so we can tell if repair mode pays off.
+# updated from request, job pool and candidate threads
+RETRY_LOCK = threading.Lock()
+RETRY_STATS = {
+    'first': {'attempts': 0, 'successes': 0},
+    'repair': {'attempts': 0, 'successes': 0},
+    'regenerate': {'attempts': 0, 'successes': 0},
+}
+
+
+def attempt_mode(attempt, previous_code=None):
+    if attempt <= 1:
+        return 'first'
+    return 'repair' if REPAIR_MODE and previous_code else 'regenerate'
+
+
+def record_attempt(mode, success):
+    with RETRY_LOCK:
+        RETRY_STATS[mode]['attempts'] += 1
+        RETRY_STATS[mode]['successes'] += int(bool(success))
+        stats = {kind: dict(counts) for kind, counts in RETRY_STATS.items()}
+    metrics.inc('trace_attempts_total', mode=mode, outcome='compiled' if success else 'failed')
+    log.info('%s attempt %s, retry stats %s', mode, 'compiled' if success else 'failed', stats)
+
+
+# "claude-haiku-4-5:1,claude-sonnet-4-6" -> [('claude-haiku-4-5', 1), ('claude-sonnet-4-6', 1)], attempts default to 1
+def parse_tiers(spec):
+    tiers = []
+    for part in spec.split(','):
+        model, _, attempts = part.strip().partition(':')
+        if model:
+            tiers.append((model, int(attempts or 1)))
+    return tiers
+
+
+# the model for a (1-based) attempt, staying on the last tier once they're all used up
+def tier_model(spec, attempt):
+    tiers = parse_tiers(spec)
+    for model, attempts in tiers:
+        if attempt <= attempts:
+            return model
+        attempt -= attempts
+    return tiers[-1][0]
+
+
+# success rate and latency per model, for zener attempts (generate + build) and schematic calls
+def record_tier(pipeline, model, success, seconds):
+    with TIER_LOCK:
+        stats = TIER_STATS.setdefault(f'{pipeline}:{model}', {'attempts': 0, 'successes': 0, 'seconds': 0.0})
+        stats['attempts'] += 1
+        stats['successes'] += int(bool(success))
+        stats['seconds'] += seconds
+    metrics.inc('trace_tier_attempts_total', pipeline=pipeline, model=model, outcome='success' if success else 'failure')
+    metrics.observe('trace_tier_seconds', seconds, pipeline=pipeline, model=model)
+
+
+# Next, Generate Zener Code
+# the messages.create arguments for one attempt. attempt 1 gets the datasheet,
+# later attempts get a compact repair prompt when we have the previous code. model defaults to the top tier
+def zener_request(datasheet_text, errors=None, previous_code=None, temperature=None, model=None):
+    if errors and previous_code and REPAIR_MODE:
+        prompt = repair_prompt(datasheet_text, previous_code, errors)
+    else:
+        prompt = datasheet_text
+        if errors:
+            diagnostics = '\n'.join(diagnostic_line(record) for record in parse_diagnostics(errors))
+            prompt += f'\n\nPrevious attempt failed with these errors:\n{diagnostics}\nFix them.'
+    
+    request = dict(
+        model = model or parse_tiers(ZENER_TIERS)[-1][0],
+        max_tokens = 5000,
+        # the spec never changes, so it's marked as a cacheable prefix and retries/later datasheets read it from cache
+        system = [{'type': 'text', 'text': ZENER_SPEC, 'cache_control': {'type': 'ephemeral'}}],
 
         messages = [{'role':'user', 'content': prompt}]
     )
+    if temperature is not None:
+        request['temperature'] = temperature
+    return request
 
+
+# on_token, if given, gets each chunk of text as it streams in from the model
+def generate_zener(client, datasheet_text, errors=None, previous_code=None, on_token=None, temperature=None,
+                   model=None, usage=None):
+    request = zener_request(datasheet_text, errors, previous_code, temperature, model)
+
+    with metrics.timed('trace_stage_seconds', stage='generate'):
+        if on_token is None:
+            message = client.messages.create(**request)
+        else:
+            # if on_token raises (e.g. the client went away) the stream is closed and we stop paying for tokens
+            with client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    on_token(text)
+                message = stream.get_final_message()
+
+    log_usage(message)
+    add_usage(usage, message)
     return message.content[0].text
 
 # Now we have to Build the PCB using the zener code that I just generated and verify that it is correct 
 # the function saves the code, runs the compiler, and tells you if it worked or not
 
+# the toolchain's version is part of every build cache key, so cached build results get thrown out when pcb gets
+# upgraded. asked again every PCB_VERSION_TTL seconds, an upgrade under a running server gets noticed too
+PCB_VERSION_TTL = float(os.environ.get('TRACE_PCB_VERSION_TTL', '300'))
+PCB_VERSION_LOCK = threading.Lock()
+PCB_VERSION = {'version': None, 'checked': 0.0}
+
+
+def pcb_version():
+    with PCB_VERSION_LOCK:
+        if PCB_VERSION['version'] is not None and time.time() - PCB_VERSION['checked'] < PCB_VERSION_TTL:
+            return PCB_VERSION['version']
+    try:
+        result = subprocess.run(["pcb", "--version"], capture_output = True, text = True, timeout = 30)
+        version = result.stdout.strip() or result.stderr.strip() or 'unknown'
+    except (OSError, subprocess.TimeoutExpired):
+        version = 'unknown'
+    with PCB_VERSION_LOCK:
+        if version != PCB_VERSION['version'] and PCB_VERSION['version'] is not None:
+            log.info('pcb version changed from %s to %s', PCB_VERSION['version'], version)
+        PCB_VERSION.update(version=version, checked=time.time())
+    return version
+
+
+# line endings, tabs, trailing spaces and blank lines don't change what pcb sees, indentation does (it's starlark)
+def normalize_zen(zen_code):
+    lines = [line.expandtabs(4).rstrip() for line in zen_code.replace('\r\n', '\n').split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def build_cache_key(zen_code, filename='output.zen'):
+    digest = hashlib.sha256(normalize_zen(zen_code).encode('utf-8')).hexdigest()
+    return f'{pcb_version()}:{filename}:{digest}'
+
+
+def cached_build(key):
+    cached = STORE.get('build', key)
+    with BUILD_CACHE_LOCK:
+        BUILD_CACHE_STATS['hits' if cached is not None else 'misses'] += 1
+    metrics.inc('trace_build_cache_total', result='hit' if cached is not None else 'miss')
+    return None if cached is None else tuple(cached)
+
+
+# successes are kept until they're evicted (or pcb changes), failures for BUILD_FAILURE_TTL
+def keep_build(key, outcome):
+    if outcome[0]:
+        STORE.set('build', key, outcome, max_entries=BUILD_CACHE_SIZE)
+    elif BUILD_FAILURE_TTL > 0:
+        STORE.set('build', key, outcome, ttl=BUILD_FAILURE_TTL, max_entries=BUILD_CACHE_SIZE)
+
+
+# (False, diagnostics) when the linter finds errors, so the build can be skipped. None means go ahead and build
+def lint_outcome(zen_code, filename='output.zen'):
+    if not LINT_BEFORE_BUILD:
+        return None
+    errors = [d for d in lint_zen(zen_code, filename) if d['severity'] == 'error']
+    metrics.inc('trace_lint_total', result='rejected' if errors else 'passed')
+    if not errors:
+        return None
+    log.info('lint rejected %s: %s', filename, ', '.join(sorted({d['code'] for d in errors})))
+    return False, format_diagnostics(errors)
+
+
 def build_zener_code(zen_code, filename='output.zen'):
-    with open(filename, "w") as f:
-        f.write(zen_code)
-    result = subprocess.run(
-        ["pcb", "build", filename],
-        capture_output = True,
-        text = True
-    )
-    return result.returncode == 0, result.stderr
+    linted = lint_outcome(zen_code, filename)
+    if linted is not None:
+        return linted
+    key = build_cache_key(zen_code, filename)
+    cached = cached_build(key)
+    if cached is not None:
+        return cached
+
+    # every build gets a workspace of its own (a warm one when there's one idle) so concurrent requests never
+    # clobber each other's output.zen
+    with BUILD_SLOTS, BUILD_WORKERS.workspace() as (workspace, warm), \
+            metrics.timed('trace_stage_seconds', stage='build'), \
+            metrics.timed('trace_build_seconds', workspace='warm' if warm else 'cold'):
+        with open(os.path.join(workspace, filename), "w") as f:
+            f.write(zen_code)
+        result = subprocess.run(
+            ["pcb", "build", filename],
+            capture_output = True,
+            text = True,
+            cwd = workspace
+        )
+    outcome = (result.returncode == 0, result.stderr)
+    keep_build(key, outcome)
+    return outcome
+
+
+# retry waits: exponential backoff with full jitter, capped at BACKOFF_MAX seconds
+def backoff_delay(retry, base=None, cap=None):
+    base = BACKOFF_BASE if base is None else base
+    cap = BACKOFF_MAX if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** retry))
+
+
+# how long to wait before retrying an anthropic error, None if it isn't worth retrying.
+# 429 (rate limited) and 529 (overloaded) honor the retry-after header when there is one
+def overload_delay(error, retry, base=None, cap=None):
+    if not isinstance(error, anthropic.APIStatusError) or error.status_code not in (429, 529):
+        return None
+    try:
+        return max(float(error.response.headers.get('retry-after')), 0.0)
+    except (TypeError, ValueError):
+        return backoff_delay(retry, base, cap)
+
+
+# Speculative candidates: one attempt sends several requests at different temperatures, builds each module
+# (in its own workspace) as soon as it arrives and keeps the first that compiles. the rest get cancelled:
+# their streams are closed so they stop costing tokens. returns (success, zen_code, errors) like one
+# generate + build would, with the lowest numbered failure when nothing compiled
+class CandidateCancelled(Exception):
+    pass
+
+
+def candidate_temperature(index):
+    return CANDIDATE_TEMPERATURES[index % len(CANDIDATE_TEMPERATURES)]
+
+
+# a sequential run would have tried candidate 0 first and then retried, so every lower numbered candidate that
+# failed to compile stands for one more round trip it would have needed (about as long as the winner took).
+# the extra cost is the output tokens of every candidate except the one we keep
+def record_race(winner, results, elapsed):
+    kept = winner if winner is not None else 0
+    extra_tokens = sum(result['tokens'] for index, result in enumerate(results) if index != kept)
+    saved = 0.0
+    if winner is not None:
+        saved = sum(1 for result in results[:winner] if result['status'] == 'failed') * results[winner]['seconds']
+    with SPECULATION_LOCK:
+        SPECULATION_STATS['races'] += 1
+        SPECULATION_STATS['wins'] += int(winner is not None)
+        SPECULATION_STATS['saved_seconds'] += saved
+        SPECULATION_STATS['extra_output_tokens'] += extra_tokens
+    metrics.inc('trace_speculation_races_total', outcome='compiled' if winner is not None else 'failed')
+    metrics.inc('trace_speculation_saved_seconds_total', saved)
+    metrics.inc('trace_speculation_extra_tokens_total', extra_tokens)
+    log.info('race of %d: %s after %.1fs, ~%.1fs saved for ~%d extra output tokens, %s',
+             len(results), f'candidate {winner} compiled' if winner is not None else 'nothing compiled',
+             elapsed, saved, extra_tokens, [result['status'] for result in results])
+
+
+# what a race comes to once it's decided. if every candidate hit an API error, the first one is raised
+# so the caller's overload handling deals with it
+def race_outcome(winner, failures, api_errors):
+    if winner is not None:
+        return winner
+    if failures:
+        return min(failures)[1:]
+    raise api_errors[0]
+
+
+def race_candidates(client, datasheet_text, candidates, errors=None, previous_code=None, report=None, attempt=1,
+                    model=None, usage=None):
+    report = report or (lambda stage, attempt, **details: None)
+    results = [{'status': 'cancelled', 'tokens': 0, 'seconds': 0.0} for _ in range(candidates)]
+    decided = threading.Event()
+    start = time.perf_counter()
+
+    def run(index):
+        begun = time.perf_counter()
+        received = []
+
+        def on_token(text):
+            if decided.is_set():
+                raise CandidateCancelled()
+            received.append(text)
+
+        try:
+            zen_code = generate_zener(client, datasheet_text, errors, previous_code, on_token,
+                                      temperature=candidate_temperature(index), model=model, usage=usage)
+        except CandidateCancelled:
+            return None
+        finally:
+            results[index]['tokens'] = estimate_tokens(''.join(received))
+        if decided.is_set():
+            return None
+        report('building', attempt, candidate=index)
+        success, build_errors = build_zener_code(zen_code)
+        results[index].update(status='compiled' if success else 'failed', seconds=time.perf_counter() - begun)
+        return success, zen_code, build_errors
+
+    pool = ThreadPoolExecutor(max_workers=candidates, thread_name_prefix='trace-candidate')
+    futures = {pool.submit(run, index): index for index in range(candidates)}
+    winner, winner_index, failures, api_errors = None, None, [], []
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                results[index]['status'] = 'error'
+                api_errors.append(e)
+                continue
+            if outcome is None:
+                continue
+            if outcome[0]:
+                winner, winner_index = outcome, index
+                break
+            failures.append((index,) + outcome)
+    finally:
+        decided.set()
+        # builds already running finish in the background, the stats get recorded once everything has stopped
+        pool.shutdown(wait=False, cancel_futures=True)
+    elapsed = time.perf_counter() - start
+    threading.Thread(target=lambda: (wait(futures), record_race(winner_index, results, elapsed)), daemon=True).start()
+    return race_outcome(winner, failures, api_errors)
 
 
 # We have defined all the processes, now we combine them and loop them to make them agentic 
+# the loop is a generator: every time it needs to wait it yields the delay in seconds and the caller decides
+# how to wait (run_steps just sleeps, the web app schedules the next step so no worker sits idle).
+# when it's done, StopIteration.value is (success, zen_code, errors)
+# with candidates > 1 every attempt is a race_candidates (on_token isn't used then, the candidates would interleave).
+# usage, if given, is a dict that gets the run's input_tokens / output_tokens added to it
+def zener_steps(client, datasheet_text, max_attempts=3, report=None, on_token=None,
+                backoff_base=None, backoff_max=None, max_overload_retries=5, candidates=None, usage=None):
+    report = report or (lambda stage, attempt, **details: None)
+    candidates = SPECULATIVE_CANDIDATES if candidates is None else candidates
+    errors = None
+    zen_code = None
+    for attempt in range(1, max_attempts + 1):
+        mode = attempt_mode(attempt, zen_code)
+        model = tier_model(ZENER_TIERS, attempt)
+        report('generating', attempt, mode=mode, candidates=candidates, model=model)
+        started = time.perf_counter()
+        for retry in range(max_overload_retries + 1):
+            try:
+                if candidates > 1:
+                    outcome = race_candidates(client, datasheet_text, candidates, errors, zen_code, report, attempt,
+                                              model, usage)
+                else:
+                    outcome = generate_zener(client, datasheet_text, errors, previous_code=zen_code, on_token=on_token,
+                                             model=model, usage=usage)
+                break
+            except anthropic.APIStatusError as e:
+                delay = overload_delay(e, retry, backoff_base, backoff_max)
+                if delay is None or retry == max_overload_retries:
+                    raise
+                report('waiting', attempt, delay=delay, reason=f'api {e.status_code}')
+                metrics.observe('trace_stage_seconds', delay, stage='backoff')
+                yield delay
+
+        if candidates > 1:
+            success, zen_code, errors = outcome
+        else:
+            zen_code = outcome
+            report('building', attempt)
+            success, errors = build_zener_code(zen_code)
+        record_attempt(mode, success)
+        record_tier('generate', model, success, time.perf_counter() - started)
+        if success:
+            metrics.inc('trace_runs_total', pipeline='generate', outcome='success')
+            return True, zen_code, errors
 
-def run_agent(datasheet_path, max_retries=3):
-    client = anthropic.Anthropic()
+        diagnostics = parse_diagnostics(errors)
+        record_diagnostics(diagnostics)
+        report('build_failed', attempt, errors=errors, diagnostics=diagnostics)
+        if attempt < max_attempts:
+            delay = backoff_delay(attempt - 1, backoff_base, backoff_max)
+            report('waiting', attempt, delay=delay)
+            metrics.observe('trace_stage_seconds', delay, stage='backoff')
+            yield delay
 
-    
-    print('Leh meh read this shit bai')
-    datasheet_text = extract_pdf(datasheet_path)
-    print(f'Got {len(datasheet_text)} characters')
+    metrics.inc('trace_runs_total', pipeline='generate', outcome='failure')
+    return False, zen_code, errors
 
-    errors = None
-    for attempt in range(1, max_retries + 1):
-        print(f'Ah buildin out d Zener bai (attempt {attempt})')
-        zen_code = generate_zener(client, datasheet_text, errors)
 
-        print('Building...')
-        success, errors = build_zener_code(zen_code)
+# async versions of generate / build / the retry loop for the ASGI app (asgi.py). same prompts, caches and
+# metrics, but the model call goes through AsyncAnthropic and pcb runs as an asyncio subprocess, so a run
+# never holds a thread while it waits. store writes (caches, metrics) go through asyncio.to_thread, the store
+# can be sqlite and a busy one would stall the loop. the loop mirrors zener_steps, keep the two in step
+BUILD_SLOT_POLL = 0.05
 
-        if success:
-            print('Write dat woking!')
-            print(zen_code)
-            return zen_code
+
+# takes one of the same BUILD_SLOTS the sync builds use, so Flask and ASGI builds in one process share the limit.
+# polls instead of blocking in asyncio.to_thread: waiting builds would fill the default executor, and the builds
+# holding a slot need it to get their metrics written and let go. a cancel while waiting leaves nothing behind
+async def acquire_build_slot():
+    while not BUILD_SLOTS.acquire(blocking=False):
+        await asyncio.sleep(BUILD_SLOT_POLL)
+
+
+async def generate_zener_async(client, datasheet_text, errors=None, previous_code=None, on_token=None,
+                               temperature=None, model=None, usage=None):
+    request = zener_request(datasheet_text, errors, previous_code, temperature, model)
+
+    async with metrics.timed_async('trace_stage_seconds', stage='generate'):
+        if on_token is None:
+            message = await client.messages.create(**request)
         else:
-            print(f'Failed, retrying...\n{errors}')
-            time.sleep(30)
+            async with client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    on_token(text)
+                message = await stream.get_final_message()
 
-            print('I fed up bai, I gone')
+    await asyncio.to_thread(log_usage, message)
+    add_usage(usage, message)
+    return message.content[0].text
+
+
+async def build_zener_code_async(zen_code, filename='output.zen'):
+    linted = await asyncio.to_thread(lint_outcome, zen_code, filename)
+    if linted is not None:
+        return linted
+    # pcb_version() runs pcb when its answer is out of date, keep that off the loop
+    key = await asyncio.to_thread(build_cache_key, zen_code, filename)
+    cached = await asyncio.to_thread(cached_build, key)
+    if cached is not None:
+        return cached
+
+    await acquire_build_slot()
+    try:
+        with BUILD_WORKERS.workspace() as (workspace, warm):
+            async with metrics.timed_async('trace_stage_seconds', stage='build'), \
+                    metrics.timed_async('trace_build_seconds', workspace='warm' if warm else 'cold'):
+                with open(os.path.join(workspace, filename), "w") as f:
+                    f.write(zen_code)
+                process = await asyncio.create_subprocess_exec(
+                    "pcb", "build", filename,
+                    stdout = asyncio.subprocess.PIPE,
+                    stderr = asyncio.subprocess.PIPE,
+                    cwd = workspace
+                )
+                try:
+                    _, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    # the request went away, don't leave pcb running
+                    process.kill()
+                    raise
+    finally:
+        BUILD_SLOTS.release()
+    outcome = (process.returncode == 0, stderr.decode('utf-8', errors='replace'))
+    await asyncio.to_thread(keep_build, key, outcome)
+    return outcome
+
+
+async def race_candidates_async(client, datasheet_text, candidates, errors=None, previous_code=None, report=None,
+                                attempt=1, model=None, usage=None):
+    report = report or (lambda stage, attempt, **details: None)
+    results = [{'status': 'cancelled', 'tokens': 0, 'seconds': 0.0} for _ in range(candidates)]
+    start = time.perf_counter()
+
+    async def run(index):
+        begun = time.perf_counter()
+        received = []
+        try:
+            zen_code = await generate_zener_async(client, datasheet_text, errors, previous_code, received.append,
+                                                  temperature=candidate_temperature(index), model=model,
+                                                  usage=usage)
+        finally:
+            results[index]['tokens'] = estimate_tokens(''.join(received))
+        report('building', attempt, candidate=index)
+        success, build_errors = await build_zener_code_async(zen_code)
+        results[index].update(status='compiled' if success else 'failed', seconds=time.perf_counter() - begun)
+        return success, zen_code, build_errors
+
+    tasks = {asyncio.ensure_future(run(index)): index for index in range(candidates)}
+    pending = set(tasks)
+    winner, winner_index, failures, api_errors = None, None, [], []
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.get):
+                index = tasks[task]
+                if task.exception() is not None:
+                    results[index]['status'] = 'error'
+                    api_errors.append(task.exception())
+                elif task.result()[0] and winner is None:
+                    winner, winner_index = task.result(), index
+                elif not task.result()[0]:
+                    failures.append((index,) + task.result())
+    finally:
+        # cancelling closes the streams and kills any pcb build still running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await asyncio.to_thread(record_race, winner_index, results, time.perf_counter() - start)
+    return race_outcome(winner, failures, api_errors)
+
+
+async def zener_run_async(client, datasheet_text, max_attempts=3, report=None, on_token=None,
+                          backoff_base=None, backoff_max=None, max_overload_retries=5, candidates=None, usage=None):
+    report = report or (lambda stage, attempt, **details: None)
+    candidates = SPECULATIVE_CANDIDATES if candidates is None else candidates
+    errors = None
+    zen_code = None
+    for attempt in range(1, max_attempts + 1):
+        mode = attempt_mode(attempt, zen_code)
+        model = tier_model(ZENER_TIERS, attempt)
+        report('generating', attempt, mode=mode, candidates=candidates, model=model)
+        started = time.perf_counter()
+        for retry in range(max_overload_retries + 1):
+            try:
+                if candidates > 1:
+                    outcome = await race_candidates_async(client, datasheet_text, candidates, errors, zen_code,
+                                                          report, attempt, model, usage)
+                else:
+                    outcome = await generate_zener_async(client, datasheet_text, errors, zen_code, on_token,
+                                                         model=model, usage=usage)
+                break
+            except anthropic.APIStatusError as e:
+                delay = overload_delay(e, retry, backoff_base, backoff_max)
+                if delay is None or retry == max_overload_retries:
+                    raise
+                report('waiting', attempt, delay=delay, reason=f'api {e.status_code}')
+                await metrics.observe_async('trace_stage_seconds', delay, stage='backoff')
+                await asyncio.sleep(delay)
+
+        if candidates > 1:
+            success, zen_code, errors = outcome
+        else:
+            zen_code = outcome
+            report('building', attempt)
+            success, errors = await build_zener_code_async(zen_code)
+        await asyncio.to_thread(record_attempt, mode, success)
+        await asyncio.to_thread(record_tier, 'generate', model, success, time.perf_counter() - started)
+        if success:
+            await metrics.inc_async('trace_runs_total', pipeline='generate', outcome='success')
+            return True, zen_code, errors
+
+        diagnostics = parse_diagnostics(errors)
+        await asyncio.to_thread(record_diagnostics, diagnostics)
+        report('build_failed', attempt, errors=errors, diagnostics=diagnostics)
+        if attempt < max_attempts:
+            delay = backoff_delay(attempt - 1, backoff_base, backoff_max)
+            report('waiting', attempt, delay=delay)
+            await metrics.observe_async('trace_stage_seconds', delay, stage='backoff')
+            await asyncio.sleep(delay)
+
+    await metrics.inc_async('trace_runs_total', pipeline='generate', outcome='failure')
+    return False, zen_code, errors
+
+
+# drives zener_steps by just sleeping through the waits, fine for the CLI
+def run_steps(steps):
+    while True:
+        try:
+            delay = next(steps)
+        except StopIteration as done:
+            return done.value
+        time.sleep(delay)
+
+
+def run_agent(datasheet_path, max_retries=3, backoff_base=None, backoff_max=None):
+    client = anthropic.Anthropic()
+
+    
+    print('Leh meh read this shit bai')
+    datasheet_text, pages = load_datasheet(datasheet_path)
+    print(f'Got {len(datasheet_text)} characters from pages {pages}')
+
+    def report(stage, attempt, **details):
+        if stage == 'generating':
+            print(f'Ah buildin out d Zener bai (attempt {attempt}, {details["mode"]}, {details["model"]})')
+        elif stage == 'building':
+            print('Building...')
+        elif stage == 'build_failed':
+            print(f'Failed, retrying...\n{details["errors"]}')
+        elif stage == 'waiting':
+            print(f'Waiting {details["delay"]:.1f}s')
+
+    success, zen_code, errors = run_steps(zener_steps(
+        client, datasheet_text, max_retries, report,
+        backoff_base=backoff_base, backoff_max=backoff_max
+    ))
+    if success:
+        print('Write dat woking!')
+        print(zen_code)
+        return zen_code
+
+    print('I fed up bai, I gone')
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     run_agent('esp32_datasheet.pdf')
 
 
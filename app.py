@@ -1,75 +1,449 @@
+import asyncio
 import os
 import tempfile
 import json
 import time
+import logging
+import sqlite3
+import threading
+import uuid
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, g, request, jsonify, send_from_directory
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import anthropic
 
-from agent import extract_pdf, generate_zener, build_zener_code
+from limits.storage import Storage
+from werkzeug.exceptions import UnsupportedMediaType
+
+from agent import (load_datasheet, zener_steps, run_steps, log_usage, add_usage, parse_tiers, record_tier, file_sha256,
+                   parse_diagnostics, pcb_version, BUILD_WORKERS)
+from artifacts import ARTIFACTS, guess_part_number
+from store import STORE, STORE_URI, SQLiteStore
+import metrics
+
+# so the token / cache usage agent.py logs actually shows up under gunicorn
+logging.basicConfig(level=os.environ.get('TRACE_LOG_LEVEL', 'INFO'))
+
+# uploads bigger than this get a 413. werkzeug checks Content-Length before reading any of the body
+# (and counts bytes when there isn't one), so an oversized pdf never reaches memory or disk
+MAX_UPLOAD_BYTES = int(float(os.environ.get('TRACE_MAX_UPLOAD_MB', '50')) * 1024 * 1024)
+
+UPLOAD_TOO_LARGE_ERROR = f"That file is too big, datasheets up to {MAX_UPLOAD_BYTES // (1024 * 1024)} MB only."
+NOT_A_PDF_ERROR = "That doesn't look like a PDF."
+
+
+# uploaded files get written straight to a temp file on disk in chunks as the body is parsed, instead of
+# werkzeug's in-memory buffer. save_upload keeps the ones we use, the rest get deleted after the request
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile(suffix='.pdf', prefix='trace_upload_', delete=False)
+        self.upload_paths = getattr(self, 'upload_paths', []) + [stream.name]
+        return stream
+
+
+# the pdf header has to be somewhere in the first 1024 bytes
+def looks_like_pdf(head):
+    return b'%PDF-' in head[:1024]
+
 
 app = Flask(__name__, static_folder='.', static_url_path='')
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 CORS(app)
 
+
+# flask-limiter storage on top of the sqlite store, registered for sqlite:// uris.
+# only does fixed windows, which is the strategy the limiter uses by default
+class SQLiteLimiterStorage(Storage):
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        path = uri[len('sqlite://'):]
+        self.store = STORE if uri == STORE_URI else SQLiteStore(path)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    # limits 3.x passes elastic_expiry (always False for the fixed window we use), 4.x dropped it
+    def incr(self, key, expiry, elastic_expiry=False, amount=1, **kwargs):
+        return self.store.incr(key, expiry, amount)
+
+    def get(self, key):
+        return self.store.counter(key)[0]
+
+    def get_expiry(self, key):
+        return self.store.counter(key)[1] or time.time()
+
+    def check(self):
+        try:
+            self.store.counter('healthcheck')
+            return True
+        except sqlite3.Error:
+            return False
+
+    # only the limiter's own counters, the store holds other ones too
+    def reset(self):
+        return self.store.reset_counters('LIMITER')
+
+    def clear(self, key):
+        self.store.clear_counter(key)
+
+
+# the limiter counts in the shared store too, otherwise every gunicorn worker hands out its own 20/day
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=[],
-    storage_uri="memory://",
+    storage_uri=STORE_URI if STORE_URI.startswith('sqlite://') else "memory://",
 )
 
 client = anthropic.Anthropic()
 
 HOSTED = os.environ.get('TRACE_HOSTED', '0') == '1'
 
+# start warming pcb workspaces now rather than on the first /generate (and again in each forked worker).
+# the hosted demo never builds, and start() itself does nothing without workers or without pcb on the PATH
+if not HOSTED:
+    BUILD_WORKERS.start()
+
+
+# end to end time for the plain JSON endpoints (streams are timed per stage instead)
+@app.before_request
+def start_timer():
+    if metrics.METRICS_ENABLED:
+        g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if metrics.METRICS_ENABLED and 'started' in g and not response.is_streamed:
+        metrics.observe('trace_request_seconds', time.perf_counter() - g.started, endpoint=request.endpoint or 'unknown')
+    return response
+
 
 @app.route('/')
 def index():
     return send_from_directory('.', 'index.html')
 
 
+HOSTED_GENERATE_ERROR = "datasheet → zener requires the local pcb toolchain and isn't available in the hosted demo. Clone the repo from github to run it locally."
+
+# background pool for /generate/jobs so the slow pipeline never ties up a web worker
+JOB_WORKERS = int(os.environ.get('TRACE_JOB_WORKERS', '2'))
+JOB_QUEUE_LIMIT = int(os.environ.get('TRACE_JOB_QUEUE_LIMIT', '16'))
+JOB_HISTORY = int(os.environ.get('TRACE_JOB_HISTORY', '200'))
+JOB_TTL = 24 * 3600
+job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='trace-job')
+# job state goes in the shared store so a poll can land on any gunicorn worker,
+# the queue limit is per process since that's what the pool is
+pending_jobs = set()
+jobs_lock = threading.Lock()
+
+
+# the upload is already on disk (see UploadRequest), this checks it's a pdf and hands over the path.
+# the caller owns the file from here on (read_upload deletes it)
+def save_upload(file):
+    head = file.stream.read(1024)
+    if not looks_like_pdf(head):
+        raise UnsupportedMediaType(NOT_A_PDF_ERROR)
+    path = file.stream.name
+    file.stream.close()
+    request.upload_paths.remove(path)
+    return path
+
+
+@app.teardown_request
+def remove_unused_uploads(error=None):
+    for path in getattr(request, 'upload_paths', []):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+# pdf -> text, removing the upload once we're done with it
+def read_upload(path):
+    try:
+        datasheet_text, pages = load_datasheet(path)
+    finally:
+        os.unlink(path)
+    app.logger.info('using datasheet pages %s (%d chars)', pages, len(datasheet_text))
+    return datasheet_text, pages
+
+
+# the generate -> build -> retry loop shared by /generate, the job workers and the stream (see agent.zener_steps).
+# report(stage, attempt, **details) gets called as the run moves along, on_token gets streamed model output,
+# usage (a dict) collects the run's token counts
+def zener_pipeline(datasheet_text, report=None, on_token=None, usage=None):
+    return zener_steps(client, datasheet_text, 3, report, on_token, usage=usage)
+
+
+# ?fresh=1 skips the cache and the artifact store and asks the model again
+def fresh_requested(args):
+    return args.get('fresh') == '1'
+
+
+# a module already generated (and compiled) for this exact pdf by the pcb we have now, from the artifact store
+def stored_module(sha, fresh=False):
+    if ARTIFACTS is None or fresh:
+        return None
+    return ARTIFACTS.find('zen', datasheet_sha=sha, details={'pcb_version': pcb_version()})
+
+
+# keeps every finished run, failed ones too, so the store also shows which parts don't build
+def keep_module(sha, datasheet_text, pages, success, zen_code, errors, usage, seconds):
+    if ARTIFACTS is None or zen_code is None:
+        return None
+    return ARTIFACTS.add('zen', zen_code, success, datasheet_sha=sha, part=guess_part_number(datasheet_text),
+                         errors=None if success else errors, usage=usage, seconds=seconds,
+                         details={'pages': pages, 'pcb_version': pcb_version()})
+
+
+def stored_module_response(stored):
+    return {'success': True, 'code': stored['content'], 'pages': stored['details'].get('pages'), 'artifact': stored['id']}
+
+
+# runs a zener_pipeline on the job pool. retry waits go on a timer instead of sleeping,
+# so the pool thread goes back to serving other runs while this one waits
+def drive(steps, on_done, on_error):
+    def advance():
+        try:
+            delay = next(steps)
+        except StopIteration as done:
+            on_done(*done.value)
+            return
+        except Exception as e:
+            on_error(e)
+            return
+        timer = threading.Timer(delay, job_pool.submit, (advance,))
+        timer.daemon = True
+        timer.start()
+
+    job_pool.submit(advance)
+
+
 @app.route('/generate', methods=['POST'])
 def generate():
     if HOSTED:
-        return jsonify({
-            'success': False,
-            'error': "datasheet → zener requires the local pcb toolchain and isn't available in the hosted demo. Clone the repo from github to run it locally."
-        }), 503
+        return jsonify({'success': False, 'error': HOSTED_GENERATE_ERROR}), 503
 
     if 'file' not in request.files:
         return jsonify({'error': 'There is no file, upload one dumbass'}), 400
 
-    file = request.files['file']
+    path = save_upload(request.files['file'])
+    sha = file_sha256(path)
+    stored = stored_module(sha, fresh_requested(request.args))
+    if stored is not None:
+        os.unlink(path)
+        return jsonify(stored_module_response(stored))
+
+    started = time.perf_counter()
+    usage = {}
+    datasheet_text, pages = read_upload(path)
+    success, zen_code, errors = run_steps(zener_pipeline(datasheet_text, usage=usage))
+    artifact = keep_module(sha, datasheet_text, pages, success, zen_code, errors, usage, time.perf_counter() - started)
+    if success:
+        return jsonify({'success': True, 'code': zen_code, 'pages': pages, 'artifact': artifact})
+    return jsonify({'success': False, 'error': errors, 'diagnostics': parse_diagnostics(errors), 'pages': pages,
+                    'artifact': artifact})
 
-    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-        file.save(tmp.name)
-        datasheet_text = extract_pdf(tmp.name)
-        os.unlink(tmp.name)
 
-    errors = None
-    for attempt in range(3):
-        zen_code = generate_zener(client, datasheet_text, errors)
-        success, errors = build_zener_code(zen_code)
+def update_job(job_id, **fields):
+    with jobs_lock:
+        job = STORE.get('jobs', job_id)
+        if job is None:
+            return
+        job.update(fields, updated=time.time())
+        STORE.set('jobs', job_id, job, ttl=JOB_TTL, max_entries=JOB_HISTORY)
+        if job['stage'] == 'done':
+            pending_jobs.discard(job_id)
+
+
+def run_job(job_id, path, fresh=False):
+    started = time.perf_counter()
+    usage = {}
+
+    def done(success, zen_code, errors):
+        keep_module(sha, datasheet_text, pages, success, zen_code, errors, usage, time.perf_counter() - started)
         if success:
-            return jsonify({'success': True, 'code': zen_code})
-        time.sleep(6.9)
+            update_job(job_id, stage='done', success=True, code=zen_code)
+        else:
+            update_job(job_id, stage='done', success=False, error=errors, diagnostics=parse_diagnostics(errors))
 
-    return jsonify({'success': False, 'error': errors})
+    def failed(e):
+        app.logger.error('job %s failed', job_id, exc_info=e)
+        update_job(job_id, stage='done', success=False, error=str(e))
 
+    try:
+        sha = file_sha256(path)
+        stored = stored_module(sha, fresh)
+        if stored is not None:
+            os.unlink(path)
+            update_job(job_id, stage='done', success=True, code=stored['content'], pages=stored['details'].get('pages'))
+            return
+        update_job(job_id, stage='extracting')
+        datasheet_text, pages = read_upload(path)
+        update_job(job_id, pages=pages)
+    except Exception as e:
+        failed(e)
+        return
+    steps = zener_pipeline(
+        datasheet_text, lambda stage, attempt, **details: update_job(job_id, stage=stage, attempt=attempt), usage=usage
+    )
+    drive(steps, done, failed)
 
-@app.route('/schematic', methods=['POST'])
-@limiter.limit("20 per day", exempt_when=lambda: not HOSTED)
-def schematic():
-    data = request.get_json()
-    prompt = data.get('prompt', '')
 
-    message = client.messages.create(
-        model='claude-sonnet-4-6',
-        max_tokens=8000,
-        system="""You are an electrical engineer. Given a natural language description of a circuit, return ONLY a valid JSON object. Keep it concise — max 10 components. Use this exact structure, no markdown, no backticks, no explanation before or after:
+# same as /generate, but hands back a job id right away. poll /generate/jobs/<id> for the result
+@app.route('/generate/jobs', methods=['POST'])
+def create_job():
+    if HOSTED:
+        return jsonify({'success': False, 'error': HOSTED_GENERATE_ERROR}), 503
+
+    if 'file' not in request.files:
+        return jsonify({'error': 'There is no file, upload one dumbass'}), 400
+
+    # checked before a job slot gets taken, a rejected upload (415) would otherwise hold its slot forever
+    path = save_upload(request.files['file'])
+    with jobs_lock:
+        if len(pending_jobs) >= JOB_QUEUE_LIMIT:
+            os.unlink(path)
+            return jsonify({'success': False, 'error': 'Too many datasheets in the queue right now, try again in a bit.'}), 503
+        job_id = uuid.uuid4().hex
+        pending_jobs.add(job_id)
+        STORE.set('jobs', job_id, {'id': job_id, 'stage': 'queued', 'attempt': 0, 'success': None,
+                                   'code': None, 'error': None, 'diagnostics': None, 'pages': None,
+                                   'created': time.time(), 'updated': time.time()},
+                  ttl=JOB_TTL, max_entries=JOB_HISTORY)
+
+    job_pool.submit(run_job, job_id, path, fresh_requested(request.args))
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+
+@app.route('/generate/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = STORE.get('jobs', job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'No job with that id'}), 404
+    return jsonify(job)
+
+
+class RunCancelled(Exception):
+    pass
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+# same pipeline as /generate, but streams server-sent events as it goes:
+# extracted, stage, token, build_failed, done. dropping the connection cancels the run
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    if HOSTED:
+        return jsonify({'success': False, 'error': HOSTED_GENERATE_ERROR}), 503
+
+    if 'file' not in request.files:
+        return jsonify({'error': 'There is no file, upload one dumbass'}), 400
+
+    # the stream runs on the job pool too, so it takes a slot the same way create_job does
+    path = save_upload(request.files['file'])
+    with jobs_lock:
+        if len(pending_jobs) >= JOB_QUEUE_LIMIT:
+            os.unlink(path)
+            return jsonify({'success': False, 'error': 'Too many datasheets in the queue right now, try again in a bit.'}), 503
+        slot = uuid.uuid4().hex
+        pending_jobs.add(slot)
+    fresh = fresh_requested(request.args)
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    # last event of the run, frees the slot
+    def finish():
+        with jobs_lock:
+            pending_jobs.discard(slot)
+        events.put(None)
+
+    def emit(event, **data):
+        if cancelled.is_set():
+            raise RunCancelled()
+        events.put(sse(event, data))
+
+    def report(stage, attempt, **details):
+        if stage == 'build_failed':
+            emit('build_failed', attempt=attempt, errors=details['errors'], diagnostics=details['diagnostics'])
+        else:
+            emit('stage', stage=stage, attempt=attempt, **details)
+
+    def done(success, zen_code, errors):
+        try:
+            artifact = keep_module(sha, datasheet_text, pages, success, zen_code, errors, usage,
+                                   time.perf_counter() - started)
+            if success:
+                emit('done', success=True, code=zen_code, pages=pages, artifact=artifact)
+            else:
+                emit('done', success=False, error=errors, diagnostics=parse_diagnostics(errors), pages=pages,
+                     artifact=artifact)
+        except RunCancelled:
+            pass
+        finally:
+            finish()
+
+    def failed(e):
+        if isinstance(e, RunCancelled):
+            app.logger.info('stream cancelled by client')
+        else:
+            app.logger.error('stream failed', exc_info=e)
+            events.put(sse('done', {'success': False, 'error': str(e)}))
+        finish()
+
+    pages = None
+    datasheet_text = None
+    sha = None
+    started = time.perf_counter()
+    usage = {}
+
+    def run():
+        nonlocal pages, datasheet_text, sha
+        try:
+            sha = file_sha256(path)
+            stored = stored_module(sha, fresh)
+            if stored is not None:
+                os.unlink(path)
+                emit('done', **stored_module_response(stored))
+                finish()
+                return
+            emit('stage', stage='extracting', attempt=0)
+            datasheet_text, pages = read_upload(path)
+            emit('extracted', chars=len(datasheet_text), pages=pages)
+        except Exception as e:
+            failed(e)
+            return
+        drive(zener_pipeline(datasheet_text, report, lambda text: emit('token', text=text), usage), done, failed)
+
+    job_pool.submit(run)
+
+    def stream():
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            # the server closes this generator when the client disconnects, so stop the run at its next step
+            cancelled.set()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+SCHEMATIC_SYSTEM = """You are an electrical engineer. Given a natural language description of a circuit, return ONLY a valid JSON object. Keep it concise — max 10 components. Use this exact structure, no markdown, no backticks, no explanation before or after:
 {
   "components": [
     {"id": "U1", "name": "ESP32", "type": "ic", "x": 300, "y": 200}
@@ -80,36 +454,459 @@ def schematic():
   "bom": [
     {"ref": "U1", "component": "ESP32-D0WD-V3", "value": "ESP32", "qty": 1, "unit_price": 2.50, "url": "https://www.digikey.com/en/products/result?keywords=ESP32-D0WD-V3", "notes": "Main MCU"}
   ]
-}""",
+}"""
+
+
+# cheap model first, a stronger one only when the answer doesn't parse. same "model:attempts" format as TRACE_ZENER_TIERS
+SCHEMATIC_TIERS = os.environ.get('TRACE_SCHEMATIC_TIERS', 'claude-haiku-4-5,claude-sonnet-4-6')
+
+
+# one model per try, in order
+def schematic_models():
+    return [model for model, attempts in parse_tiers(SCHEMATIC_TIERS) for _ in range(attempts)]
+
+
+def schematic_request(prompt, model=None):
+    return dict(
+        model=model or schematic_models()[-1],
+        max_tokens=8000,
+        system=SCHEMATIC_SYSTEM,
         tools=[{"type": "web_search_20250305", "name": "web_search"}],
         messages=[{'role': 'user', 'content': f"Design a circuit for: {prompt}. Keep it to the essential components only, max 10."}]
     )
 
+
+# grabs the span from the first { to the last } and parses it
+def parse_schematic_json(text):
+    text = text.strip()
+
+    start = text.find('{')
+    end = text.rfind('}') + 1
+    if start == -1 or end == 0:
+        raise ValueError("No JSON found in response")
+
+    return json.loads(text[start:end])
+
+
+# incremental parser for the schematic JSON as it streams in. feed() it text deltas and it hands back
+# every components / connections / bom entry as soon as its closing brace arrives.
+# it tracks strings and nesting, so braces inside strings or chatter before the JSON don't throw it off
+class SchematicStreamParser:
+    SECTIONS = ('components', 'connections', 'bom')
+
+    def __init__(self):
+        self.text = ''
+        self.pos = 0
+        self.reset()
+
+    # forget the object we're in and go back to looking for the start of one
+    def reset(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.last_key = None
+        self.section = None
+        self.item_start = None
+        self.root_start = None
+        self.root_end = None
+
+    def feed(self, chunk):
+        items = []
+        self.text += chunk
+        while self.pos < len(self.text) and self.root_end is None:
+            i = self.pos
+            ch = self.text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = self.text[self.string_start + 1:i]
+            elif self.root_start is None:
+                if ch == '{':
+                    # only an object that opens with a key counts, so "{like this}" in prose gets skipped
+                    rest = self.text[i + 1:].lstrip()
+                    if not rest:
+                        break # wait for more text before deciding
+                    if rest[0] == '"':
+                        self.root_start = i
+                        self.depth = 1
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = i
+            elif ch in '{[':
+                self.depth += 1
+                if ch == '[' and self.depth == 2:
+                    self.section = self.last_key if self.last_key in self.SECTIONS else None
+                elif ch == '{' and self.depth == 3 and self.section:
+                    self.item_start = i
+            elif ch in '}]':
+                if ch == '}' and self.depth == 3 and self.item_start is not None:
+                    try:
+                        items.append((self.section, json.loads(self.text[self.item_start:i + 1])))
+                    except ValueError:
+                        pass
+                    self.item_start = None
+                self.depth -= 1
+                if self.depth == 1:
+                    self.section = None
+                elif self.depth == 0:
+                    try:
+                        root = json.loads(self.text[self.root_start:i + 1])
+                    except ValueError:
+                        root = {}
+                    if not any(section in root for section in self.SECTIONS):
+                        # not the real object after all, start looking again right after its opening brace
+                        self.pos = self.root_start + 1
+                        self.reset()
+                        continue
+                    self.root_end = i + 1
+            self.pos += 1
+        return items
+
+    # the whole object once the stream is done, falling back to the first-{-to-last-} parse
+    def result(self):
+        if self.root_end is not None:
+            try:
+                return json.loads(self.text[self.root_start:self.root_end])
+            except ValueError:
+                pass
+        return parse_schematic_json(self.text)
+
+
+# results for prompts we've already answered, in the shared store. while one request (in any worker) is
+# asking the model about a prompt, identical prompts wait for its answer instead of making their own call
+class SchematicCache:
+    # wait is how long an identical prompt waits for the call already running, claim_ttl how long an in-flight
+    # claim lives without its owner refreshing it (so a killed worker doesn't hold the prompt hostage)
+    def __init__(self, store, ttl, size, wait, poll=0.25, claim_ttl=15):
+        self.store = store
+        self.ttl = ttl
+        self.size = size
+        self.wait = wait
+        self.poll = poll
+        self.claim_ttl = claim_ttl
+        self.claims = {}
+        self.claims_lock = threading.Lock()
+
+    # returns (result, source) where source is 'hit', 'shared' or 'miss'.
+    # on a miss the caller owns the prompt and has to finish() it, even if the call fails.
+    # fresh is always a miss: it takes the claim if it's free but doesn't wait on someone else's call
+    def lookup(self, key, fresh=False):
+        deadline = time.time() + self.wait
+        waited = False
+        while True:
+            found = self._check(key, waited, deadline, fresh)
+            if found is not None:
+                return found
+            waited = True
+            time.sleep(self.poll)
+
+    # same as lookup, for the ASGI app (waits without holding a thread, each look at the store runs on one)
+    async def lookup_async(self, key, fresh=False):
+        deadline = time.time() + self.wait
+        waited = False
+        while True:
+            found = await asyncio.to_thread(self._check, key, waited, deadline, fresh)
+            if found is not None:
+                return found
+            waited = True
+            await asyncio.sleep(self.poll)
+
+    # one look at the store, None while someone else is still asking the model
+    def _check(self, key, waited, deadline, fresh=False):
+        result = None if fresh else self.store.get('schematic', key)
+        if result is not None:
+            return result, 'shared' if waited else 'hit'
+        # nobody's on it (or whoever was gave up / failed / died), so it's ours
+        if self.store.add('schematic_inflight', key, os.getpid(), ttl=self.claim_ttl):
+            self._hold(key)
+            return None, 'miss'
+        if fresh or time.time() > deadline:
+            return None, 'miss'
+        return None
+
+    # keeps refreshing the claim until finish(), the call can take longer than claim_ttl
+    def _hold(self, key):
+        stop = threading.Event()
+        with self.claims_lock:
+            self.claims[key] = stop
+
+        def refresh():
+            while not stop.wait(self.claim_ttl / 3):
+                # under the lock, so a refresh can't bring the claim back after finish() deleted it
+                with self.claims_lock:
+                    if stop.is_set():
+                        return
+                    self.store.set('schematic_inflight', key, os.getpid(), ttl=self.claim_ttl)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    # caches the result if the call worked (None if it didn't) and lets the waiters go
+    def finish(self, key, result):
+        with self.claims_lock:
+            stop = self.claims.pop(key, None)
+            if stop is not None:
+                stop.set()
+        if result is not None:
+            self.store.set('schematic', key, result, ttl=self.ttl, max_entries=self.size)
+        self.store.delete('schematic_inflight', key)
+
+
+SCHEMATIC_CACHE_TTL = float(os.environ.get('TRACE_SCHEMATIC_CACHE_TTL', str(24 * 3600)))
+SCHEMATIC_CACHE_SIZE = int(os.environ.get('TRACE_SCHEMATIC_CACHE_SIZE', '256'))
+# well under gunicorn's --timeout (120 in the Procfile), a waiter holds a sync worker the whole time
+SCHEMATIC_WAIT = float(os.environ.get('TRACE_SCHEMATIC_WAIT', '45'))
+SCHEMATIC_CLAIM_TTL = float(os.environ.get('TRACE_SCHEMATIC_CLAIM_TTL', '15'))
+schematic_cache = SchematicCache(STORE, SCHEMATIC_CACHE_TTL, SCHEMATIC_CACHE_SIZE, SCHEMATIC_WAIT,
+                                 claim_ttl=SCHEMATIC_CLAIM_TTL)
+
+
+# "ESP32 with USB charging." and "esp32  with usb charging" should be the same request
+def normalize_prompt(prompt):
+    return ' '.join(prompt.lower().split()).strip(' .!?')
+
+
+# a prompt the cache has forgotten may still be in the artifact store, if it's no older than the cache would
+# have kept it. takes what SchematicCache.lookup returned, on an artifact hit the prompt is finished (cached again)
+# and the source is 'artifact'
+def with_artifacts(key, result, source, fresh=False):
+    if result is None and ARTIFACTS is not None and not fresh:
+        stored = ARTIFACTS.find('schematic', prompt=key, newer_than=time.time() - SCHEMATIC_CACHE_TTL)
+        if stored is not None:
+            schematic_cache.finish(key, stored['content'])
+            return stored['content'], 'artifact'
+    return result, source
+
+
+def keep_schematic(key, result, usage, seconds):
+    if ARTIFACTS is not None and result is not None:
+        ARTIFACTS.add('schematic', result, True, prompt=key, usage=usage, seconds=seconds)
+
+
+# answers served from the cache (or off someone else's call) don't count against the hosted daily limit,
+# and neither do responses that never got to the model (a 429 from the limit itself, a bad request)
+def upstream_call_made(response):
+    return response.status_code == 200 and response.headers.get('X-Trace-Cache', 'miss') == 'miss'
+
+
+# whether the cache or the artifact store already has an answer for this prompt. only a peek (no claim), so
+# a prompt that's free to answer skips the daily limit check instead of getting a 429 once the limit is used up
+def schematic_answer_cached(key, fresh=False):
+    if fresh:
+        return False
+    if schematic_cache.store.get('schematic', key) is not None:
+        return True
+    return ARTIFACTS is not None and ARTIFACTS.find(
+        'schematic', prompt=key, newer_than=time.time() - SCHEMATIC_CACHE_TTL) is not None
+
+
+def schematic_limit_exempt():
+    if not HOSTED:
+        return True
+    data = request.get_json(silent=True) or {}
+    return schematic_answer_cached(normalize_prompt(data.get('prompt', '')), fresh_requested(request.args))
+
+
+@app.route('/schematic', methods=['POST'])
+@limiter.limit("20 per day", exempt_when=schematic_limit_exempt, deduct_when=upstream_call_made)
+def schematic():
+    data = request.get_json()
+    prompt = data.get('prompt', '')
+
+    key = normalize_prompt(prompt)
+    fresh = fresh_requested(request.args)
+    result, source = with_artifacts(key, *schematic_cache.lookup(key, fresh), fresh)
+    metrics.inc('trace_schematic_cache_total', result=source)
+    if result is not None:
+        response = jsonify({'success': True, 'data': result})
+        response.headers['X-Trace-Cache'] = source
+        return response
+
+    result = None
+    started = time.perf_counter()
+    usage = {}
     try:
-        text = ""
-        for block in message.content:
-            if block.type == "text":
-                text += block.text
+        for model in schematic_models():
+            tier_started = time.perf_counter()
+            with metrics.timed('trace_stage_seconds', stage='schematic'):
+                message = client.messages.create(**schematic_request(prompt, model))
+            log_usage(message, 'schematic')
+            add_usage(usage, message)
 
-        text = text.strip()
+            try:
+                text = ""
+                for block in message.content:
+                    if block.type == "text":
+                        text += block.text
 
-        start = text.find('{')
-        end = text.rfind('}') + 1
-        if start == -1 or end == 0:
-            raise ValueError("No JSON found in response")
+                result = parse_schematic_json(text)
+            except Exception as e:
+                error = e
+            record_tier('schematic', model, result is not None, time.perf_counter() - tier_started)
+            if result is not None:
+                keep_schematic(key, result, usage, time.perf_counter() - started)
+                return jsonify({'success': True, 'data': result})
+            app.logger.info("%s schematic didn't parse, moving up a tier", model)
+        return jsonify({'success': False, 'error': f'Parse error: {str(error)}, raw: {text[:200]}'})
+    finally:
+        metrics.inc('trace_runs_total', pipeline='schematic', outcome='success' if result is not None else 'failure')
+        schematic_cache.finish(key, result)
 
-        text = text[start:end]
-        result = json.loads(text)
-        return jsonify({'success': True, 'data': result})
-    except Exception as e:
-        return jsonify({'success': False, 'error': f'Parse error: {str(e)}, raw: {text[:200]}'})
+
+SCHEMATIC_EVENTS = {'components': 'component', 'connections': 'connection', 'bom': 'bom'}
+
+
+# same as /schematic, but streams server-sent events: component, connection and bom for each entry
+# as soon as the model finishes writing it, then done with the whole object. escalated means the answer
+# didn't parse and a bigger model is starting over, so drop what's been drawn so far
+@app.route('/schematic/stream', methods=['POST'])
+@limiter.limit("20 per day", exempt_when=schematic_limit_exempt, deduct_when=upstream_call_made)
+def schematic_stream():
+    data = request.get_json()
+    prompt = data.get('prompt', '')
+
+    key = normalize_prompt(prompt)
+    fresh = fresh_requested(request.args)
+    cached, source = with_artifacts(key, *schematic_cache.lookup(key, fresh), fresh)
+    metrics.inc('trace_schematic_cache_total', result=source)
+
+    # a cached answer gets replayed as the same events a live one would produce
+    def replay():
+        for section, event in SCHEMATIC_EVENTS.items():
+            for item in cached.get(section, []):
+                yield sse(event, item)
+        yield sse('done', {'success': True, 'data': cached})
+
+    def stream():
+        result = None
+        started = time.perf_counter()
+        usage = {}
+        try:
+            for tier, model in enumerate(schematic_models()):
+                if tier:
+                    yield sse('escalated', {'model': model})
+                parser = SchematicStreamParser()
+                tier_started = time.perf_counter()
+                try:
+                    with metrics.timed('trace_stage_seconds', stage='schematic'), \
+                            client.messages.stream(**schematic_request(prompt, model)) as response:
+                        for chunk in response.text_stream:
+                            for section, item in parser.feed(chunk):
+                                yield sse(SCHEMATIC_EVENTS[section], item)
+                        message = response.get_final_message()
+                    log_usage(message, 'schematic')
+                    add_usage(usage, message)
+                except Exception as e:
+                    yield sse('done', {'success': False, 'error': str(e)})
+                    return
+
+                try:
+                    result = parser.result()
+                except Exception as e:
+                    error = e
+                record_tier('schematic', model, result is not None, time.perf_counter() - tier_started)
+                if result is not None:
+                    keep_schematic(key, result, usage, time.perf_counter() - started)
+                    yield sse('done', {'success': True, 'data': result})
+                    return
+            yield sse('done', {'success': False, 'error': f'Parse error: {str(error)}, raw: {parser.text.strip()[:200]}'})
+        finally:
+            metrics.inc('trace_runs_total', pipeline='schematic', outcome='success' if result is not None else 'failure')
+            schematic_cache.finish(key, result)
+
+    response = Response(replay() if cached is not None else stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.headers['X-Trace-Cache'] = source
+    return response
+
+
+# everything generated so far, newest first, without the content. filters: kind (zen / schematic), datasheet
+# (sha256 of the pdf), part, prompt, success, plus limit / offset
+# on the hosted demo the store holds every visitor's prompts, so there's no listing and no fetching by id there,
+# only a lookup by the exact prompt (which is what /schematic would hand back anyway)
+HOSTED_ARTIFACTS_ERROR = 'Browsing artifacts is turned off on the hosted demo, look one up by its prompt instead.'
+
+
+@app.route('/artifacts')
+def list_artifacts():
+    if ARTIFACTS is None:
+        return jsonify({'success': False, 'error': 'the artifact store is off (TRACE_ARTIFACTS=off)'}), 404
+    if HOSTED:
+        return jsonify({'success': False, 'error': HOSTED_ARTIFACTS_ERROR}), 404
+    args = request.args
+    success = args.get('success')
+    artifacts = ARTIFACTS.list(
+        kind=args.get('kind'), datasheet_sha=args.get('datasheet'), part=args.get('part'),
+        prompt=normalize_prompt(args['prompt']) if 'prompt' in args else None,
+        success=None if success is None else success.lower() in ('1', 'true', 'yes'),
+        limit=min(args.get('limit', 50, type=int), 500), offset=args.get('offset', 0, type=int),
+    )
+    return jsonify({'success': True, 'artifacts': artifacts})
+
+
+# the newest successful artifact for a datasheet sha, part number or prompt, content included
+@app.route('/artifacts/lookup')
+def lookup_artifact():
+    if ARTIFACTS is None:
+        return jsonify({'success': False, 'error': 'the artifact store is off (TRACE_ARTIFACTS=off)'}), 404
+    args = request.args
+    if HOSTED:
+        if not args.get('prompt', '').strip():
+            return jsonify({'success': False, 'error': 'look up by prompt'}), 400
+        artifact = ARTIFACTS.find('schematic', prompt=normalize_prompt(args['prompt']))
+    elif not any(name in args for name in ('datasheet', 'part', 'prompt')):
+        return jsonify({'success': False, 'error': 'look up by datasheet, part or prompt'}), 400
+    else:
+        artifact = ARTIFACTS.find(
+            kind=args.get('kind'), datasheet_sha=args.get('datasheet'), part=args.get('part'),
+            prompt=normalize_prompt(args['prompt']) if 'prompt' in args else None,
+        )
+    if artifact is None:
+        return jsonify({'success': False, 'error': 'Nothing stored for that yet'}), 404
+    return jsonify({'success': True, 'artifact': artifact})
+
+
+@app.route('/artifacts/<int:artifact_id>')
+def get_artifact(artifact_id):
+    if HOSTED:
+        return jsonify({'success': False, 'error': HOSTED_ARTIFACTS_ERROR}), 404
+    artifact = ARTIFACTS.get(artifact_id) if ARTIFACTS is not None else None
+    if artifact is None:
+        return jsonify({'success': False, 'error': 'No artifact with that id'}), 404
+    return jsonify({'success': True, 'artifact': artifact})
+
+
+# Prometheus scrape endpoint, only there when TRACE_METRICS=1
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        return jsonify({'error': 'metrics are off, set TRACE_METRICS=1'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+RATE_LIMIT_ERROR = "Rate limit reached (20 requests per day per IP on the hosted demo). Clone the repo to run it locally without limits."
+
+
+@app.errorhandler(413)
+def too_large_handler(e):
+    return jsonify({'success': False, 'error': UPLOAD_TOO_LARGE_ERROR}), 413
+
+
+@app.errorhandler(415)
+def not_a_pdf_handler(e):
+    return jsonify({'success': False, 'error': e.description}), 415
 
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
     return jsonify({
         'success': False,
-        'error': "Rate limit reached (20 requests per day per IP on the hosted demo). Clone the repo to run it locally without limits."
+        'error': RATE_LIMIT_ERROR
     }), 429
 
 
@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from store import thread_connection
+
+# Every generated module and schematic, kept for good (unlike the caches in store.py) so the next request for
+# the same datasheet, part or prompt is a lookup instead of another generation.
+# TRACE_ARTIFACTS is the sqlite file, "off" turns the whole thing off
+ARTIFACTS_PATH = os.environ.get('TRACE_ARTIFACTS', os.path.join(os.path.expanduser('~'), '.trace', 'artifacts.sqlite3'))
+
+# what list() returns per artifact, content is only in get / find
+SUMMARY_COLUMNS = ('id', 'kind', 'datasheet_sha', 'part', 'prompt', 'success', 'input_tokens', 'output_tokens',
+                   'seconds', 'created')
+COLUMNS = SUMMARY_COLUMNS + ('content', 'errors', 'details')
+
+# tokens that look like part numbers but are pins, rails, standards etc.
+_NOT_PARTS = re.compile(r'^(GPIO|VDD|VCC|VSS|VIN|VOUT|PIN|REV|ISO|IEC|JESD|RS|I2C|I2S|USB|UART|SPI|ADC|DAC|PWM|CH|PA|PB|PC|PD|RGB)\d')
+_PART = re.compile(r'\b[A-Z][A-Z0-9]*\d[A-Z0-9]*(?:-[A-Z0-9]+)*\b')
+
+
+# best guess at the part number a datasheet is about: the most common part-number-looking token,
+# with the first page (where the title is) counting extra. None if nothing looks like one
+def guess_part_number(datasheet_text):
+    counts = Counter()
+    for position, match in enumerate(_PART.finditer(datasheet_text)):
+        token = match.group()
+        letters = sum(ch.isalpha() for ch in token)
+        if len(token) < 4 or letters < 2 or len(token) - letters < 2 or _NOT_PARTS.match(token):
+            continue
+        counts[token] += 3 if match.start() < 2000 else 1
+    if not counts:
+        return None
+    return counts.most_common(1)[0][0]
+
+
+class ArtifactStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connect().db.execute('PRAGMA journal_mode=WAL')
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, datasheet_sha TEXT, part TEXT, prompt TEXT,
+                success INTEGER, input_tokens INTEGER, output_tokens INTEGER, seconds REAL, created REAL,
+                content TEXT, errors TEXT, details TEXT)''')
+            for column in ('datasheet_sha', 'part', 'prompt'):
+                db.execute(f'CREATE INDEX IF NOT EXISTS artifacts_{column} ON artifacts (kind, {column}, created)')
+
+    def connect(self):
+        return thread_connection(self.local, self.path)
+
+    # kind is 'zen' or 'schematic', content the module source or the schematic object. returns the new id
+    def add(self, kind, content, success, datasheet_sha=None, part=None, prompt=None, errors=None,
+            usage=None, seconds=None, details=None):
+        usage = usage or {}
+        with self.connect() as db:
+            cursor = db.execute(
+                f'INSERT INTO artifacts ({", ".join(COLUMNS[1:])}) VALUES ({", ".join("?" * (len(COLUMNS) - 1))})',
+                (kind, datasheet_sha, part.upper() if part else None, prompt, int(bool(success)),
+                 usage.get('input_tokens', 0), usage.get('output_tokens', 0), seconds, time.time(),
+                 json.dumps(content), errors, json.dumps(details or {})))
+            return cursor.lastrowid
+
+    def get(self, artifact_id):
+        with self.connect() as db:
+            row = db.execute(f'SELECT {", ".join(COLUMNS)} FROM artifacts WHERE id=?', (artifact_id,)).fetchone()
+        return self._full(row)
+
+    # the newest successful artifact matching every filter given, None if there isn't one.
+    # details matches keys of the details dict, newer_than is a created cutoff (time.time() style)
+    def find(self, kind=None, datasheet_sha=None, part=None, prompt=None, details=None, newer_than=None):
+        where, params = self._where(kind, datasheet_sha, part, prompt, success=True)
+        extra = [(f"json_extract(details, '$.{key}')=?", value) for key, value in (details or {}).items()]
+        if newer_than is not None:
+            extra.append(('created>?', newer_than))
+        if extra:
+            where = (where + ' AND ' if where else 'WHERE ') + ' AND '.join(clause for clause, _ in extra)
+            params = params + [value for _, value in extra]
+        with self.connect() as db:
+            row = db.execute(f'SELECT {", ".join(COLUMNS)} FROM artifacts {where} ORDER BY created DESC LIMIT 1',
+                             params).fetchone()
+        return self._full(row)
+
+    # newest first, without the content
+    def list(self, kind=None, datasheet_sha=None, part=None, prompt=None, success=None, limit=50, offset=0):
+        where, params = self._where(kind, datasheet_sha, part, prompt, success)
+        with self.connect() as db:
+            rows = db.execute(f'SELECT {", ".join(SUMMARY_COLUMNS)} FROM artifacts {where} '
+                              'ORDER BY created DESC LIMIT ? OFFSET ?', params + [limit, offset]).fetchall()
+        return [dict(zip(SUMMARY_COLUMNS, row), success=bool(row[5])) for row in rows]
+
+    def _where(self, kind, datasheet_sha, part, prompt, success):
+        filters = {'kind': kind, 'datasheet_sha': datasheet_sha, 'part': part.upper() if part else None,
+                   'prompt': prompt, 'success': None if success is None else int(bool(success))}
+        used = [(column, value) for column, value in filters.items() if value is not None]
+        if not used:
+            return '', []
+        return 'WHERE ' + ' AND '.join(f'{column}=?' for column, _ in used), [value for _, value in used]
+
+    def _full(self, row):
+        if row is None:
+            return None
+        artifact = dict(zip(COLUMNS, row))
+        artifact.update(success=bool(artifact['success']), content=json.loads(artifact['content']),
+                        details=json.loads(artifact['details']))
+        return artifact
+
+
+ARTIFACTS = None if ARTIFACTS_PATH.lower() in ('', 'off', '0') else ArtifactStore(ARTIFACTS_PATH)
@@ -0,0 +1,372 @@
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+import logging
+
+import anthropic
+from a2wsgi import WSGIMiddleware
+from limits import parse
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as flask_app
+from app import (HOSTED, HOSTED_GENERATE_ERROR, MAX_UPLOAD_BYTES, NOT_A_PDF_ERROR, RATE_LIMIT_ERROR, SCHEMATIC_EVENTS,
+                 UPLOAD_TOO_LARGE_ERROR, SchematicStreamParser, fresh_requested, keep_module, keep_schematic, limiter,
+                 looks_like_pdf, normalize_prompt, parse_schematic_json, read_upload, schematic_answer_cached,
+                 schematic_cache, schematic_models, schematic_request, sse, stored_module, stored_module_response,
+                 with_artifacts)
+from agent import add_usage, file_sha256, log_usage, parse_diagnostics, pcb_version, record_tier, zener_run_async
+import metrics
+
+# Async serving mode. under gunicorn's sync workers every worker holds one request at a time, and almost all of
+# that time is spent waiting on the model. here the LLM-heavy endpoints run on one event loop instead:
+#   uvicorn asgi:app --host 0.0.0.0 --port 5700
+#   gunicorn -k uvicorn.workers.UvicornWorker --workers 2 --timeout 120 asgi:app
+# /schematic, /schematic/stream, /generate and /generate/stream go through AsyncAnthropic and an asyncio
+# pcb subprocess (see zener_run_async), pdf extraction goes to a thread. everything else (jobs, /metrics,
+# the frontend) is the Flask app mounted underneath, so both modes serve the same API
+log = logging.getLogger(__name__)
+
+# past this many requests in flight the server answers 503 straight away instead of queueing forever
+MAX_INFLIGHT = int(os.environ.get('TRACE_MAX_INFLIGHT', '64'))
+
+# one client per process, so every request reuses its keep-alive connection pool to the API
+client = anthropic.AsyncAnthropic()
+
+# the hosted daily limit, counted in the same storage the Flask limiter uses
+SCHEMATIC_LIMIT = parse('20 per day')
+
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def client_ip(request):
+    return request.client.host if request.client else '127.0.0.1'
+
+
+# a prompt the cache or the artifact store can answer never hits the limit, see schematic_limit_exempt in app.py
+def limit_reached(request, key, fresh):
+    return (HOSTED and not schematic_answer_cached(key, fresh)
+            and not limiter.limiter.test(SCHEMATIC_LIMIT, 'schematic', client_ip(request)))
+
+
+# only answers that actually called the model count, same as upstream_call_made in app.py
+def count_call(request):
+    if HOSTED:
+        limiter.limiter.hit(SCHEMATIC_LIMIT, 'schematic', client_ip(request))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+# the same request, but reading more than limit bytes of body raises UploadTooLarge. covers uploads
+# that come without a Content-Length
+def capped(request, limit):
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get('body', b''))
+        if received > limit:
+            raise UploadTooLarge()
+        return message
+
+    return Request(request.scope, receive)
+
+
+# pulls the uploaded pdf out of the form and into a temp file, or returns an error response.
+# same limits as the Flask app: too big is a 413 (from Content-Length when there is one), not a pdf is a 415
+async def save_upload(request):
+    too_large = JSONResponse({'success': False, 'error': UPLOAD_TOO_LARGE_ERROR}, status_code=413)
+    try:
+        if int(request.headers.get('content-length', 0)) > MAX_UPLOAD_BYTES:
+            return None, too_large
+    except ValueError:
+        pass
+
+    # multipart parsing spools files to disk in chunks past 1 MB
+    try:
+        form = await capped(request, MAX_UPLOAD_BYTES).form()
+    except UploadTooLarge:
+        return None, too_large
+    try:
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            return None, JSONResponse({'error': 'There is no file, upload one dumbass'}, status_code=400)
+        if not looks_like_pdf(await upload.read(1024)):
+            return None, JSONResponse({'success': False, 'error': NOT_A_PDF_ERROR}, status_code=415)
+        await upload.seek(0)
+
+        def copy():
+            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+                shutil.copyfileobj(upload.file, tmp)
+            return tmp.name
+
+        return await asyncio.to_thread(copy), None
+    finally:
+        await form.close()
+
+
+async def generate(request):
+    if HOSTED:
+        return JSONResponse({'success': False, 'error': HOSTED_GENERATE_ERROR}, status_code=503)
+
+    path, error = await save_upload(request)
+    if error is not None:
+        return error
+
+    sha = await asyncio.to_thread(file_sha256, path)
+    stored = await asyncio.to_thread(stored_module, sha, fresh_requested(request.query_params))
+    if stored is not None:
+        os.unlink(path)
+        return JSONResponse(stored_module_response(stored))
+
+    started = time.perf_counter()
+    usage = {}
+    async with metrics.timed_async('trace_request_seconds', endpoint='generate'):
+        datasheet_text, pages = await asyncio.to_thread(read_upload, path)
+        success, zen_code, errors = await zener_run_async(client, datasheet_text, 3, usage=usage)
+    artifact = await asyncio.to_thread(keep_module, sha, datasheet_text, pages, success, zen_code, errors, usage,
+                                       time.perf_counter() - started)
+    if success:
+        return JSONResponse({'success': True, 'code': zen_code, 'pages': pages, 'artifact': artifact})
+    return JSONResponse({'success': False, 'error': errors, 'diagnostics': parse_diagnostics(errors), 'pages': pages,
+                         'artifact': artifact})
+
+
+# same events as the Flask /generate/stream. a dropped connection cancels the stream, which cancels the run
+async def generate_stream(request):
+    if HOSTED:
+        return JSONResponse({'success': False, 'error': HOSTED_GENERATE_ERROR}, status_code=503)
+
+    path, error = await save_upload(request)
+    if error is not None:
+        return error
+
+    fresh = fresh_requested(request.query_params)
+
+    async def stream():
+        sha = await asyncio.to_thread(file_sha256, path)
+        stored = await asyncio.to_thread(stored_module, sha, fresh)
+        if stored is not None:
+            os.unlink(path)
+            yield sse('done', stored_module_response(stored))
+            return
+
+        started = time.perf_counter()
+        usage = {}
+        yield sse('stage', {'stage': 'extracting', 'attempt': 0})
+        try:
+            datasheet_text, pages = await asyncio.to_thread(read_upload, path)
+        except Exception as e:
+            log.error('stream failed', exc_info=e)
+            yield sse('done', {'success': False, 'error': str(e)})
+            return
+        yield sse('extracted', {'chars': len(datasheet_text), 'pages': pages})
+
+        events = asyncio.Queue()
+
+        def report(stage, attempt, **details):
+            if stage == 'build_failed':
+                events.put_nowait(sse('build_failed', {'attempt': attempt, 'errors': details['errors'],
+                                                       'diagnostics': details['diagnostics']}))
+            else:
+                events.put_nowait(sse('stage', dict(details, stage=stage, attempt=attempt)))
+
+        run = asyncio.ensure_future(zener_run_async(
+            client, datasheet_text, 3, report, lambda text: events.put_nowait(sse('token', {'text': text})), usage=usage
+        ))
+        run.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+            try:
+                success, zen_code, errors = run.result()
+            except Exception as e:
+                log.error('stream failed', exc_info=e)
+                yield sse('done', {'success': False, 'error': str(e)})
+                return
+            artifact = await asyncio.to_thread(keep_module, sha, datasheet_text, pages, success, zen_code, errors,
+                                               usage, time.perf_counter() - started)
+            if success:
+                yield sse('done', {'success': True, 'code': zen_code, 'pages': pages, 'artifact': artifact})
+            else:
+                yield sse('done', {'success': False, 'error': errors, 'diagnostics': parse_diagnostics(errors),
+                                   'pages': pages, 'artifact': artifact})
+        finally:
+            if not run.done():
+                log.info('stream cancelled by client')
+                run.cancel()
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers=STREAM_HEADERS)
+
+
+async def schematic(request):
+    data = await request.json()
+    prompt = data.get('prompt', '')
+
+    key = normalize_prompt(prompt)
+    fresh = fresh_requested(request.query_params)
+    if await asyncio.to_thread(limit_reached, request, key, fresh):
+        return JSONResponse({'success': False, 'error': RATE_LIMIT_ERROR}, status_code=429)
+    result, source = await asyncio.to_thread(with_artifacts, key, *await schematic_cache.lookup_async(key, fresh),
+                                             fresh)
+    await metrics.inc_async('trace_schematic_cache_total', result=source)
+    if result is not None:
+        return JSONResponse({'success': True, 'data': result}, headers={'X-Trace-Cache': source})
+
+    await asyncio.to_thread(count_call, request)
+    result = None
+    started = time.perf_counter()
+    usage = {}
+    try:
+        async with metrics.timed_async('trace_request_seconds', endpoint='schematic'):
+            for model in schematic_models():
+                tier_started = time.perf_counter()
+                async with metrics.timed_async('trace_stage_seconds', stage='schematic'):
+                    message = await client.messages.create(**schematic_request(prompt, model))
+                await asyncio.to_thread(log_usage, message, 'schematic')
+                add_usage(usage, message)
+
+                text = ''
+                try:
+                    for block in message.content:
+                        if block.type == "text":
+                            text += block.text
+
+                    result = parse_schematic_json(text)
+                except Exception as e:
+                    error = e
+                await asyncio.to_thread(record_tier, 'schematic', model, result is not None,
+                                        time.perf_counter() - tier_started)
+                if result is not None:
+                    await asyncio.to_thread(keep_schematic, key, result, usage, time.perf_counter() - started)
+                    return JSONResponse({'success': True, 'data': result}, headers={'X-Trace-Cache': source})
+                log.info("%s schematic didn't parse, moving up a tier", model)
+        return JSONResponse({'success': False, 'error': f'Parse error: {str(error)}, raw: {text[:200]}'},
+                            headers={'X-Trace-Cache': source})
+    finally:
+        await metrics.inc_async('trace_runs_total', pipeline='schematic',
+                                outcome='success' if result is not None else 'failure')
+        await asyncio.to_thread(schematic_cache.finish, key, result)
+
+
+async def schematic_stream(request):
+    data = await request.json()
+    prompt = data.get('prompt', '')
+
+    key = normalize_prompt(prompt)
+    fresh = fresh_requested(request.query_params)
+    if await asyncio.to_thread(limit_reached, request, key, fresh):
+        return JSONResponse({'success': False, 'error': RATE_LIMIT_ERROR}, status_code=429)
+    cached, source = await asyncio.to_thread(with_artifacts, key, *await schematic_cache.lookup_async(key, fresh),
+                                             fresh)
+    await metrics.inc_async('trace_schematic_cache_total', result=source)
+
+    async def replay():
+        for section, event in SCHEMATIC_EVENTS.items():
+            for item in cached.get(section, []):
+                yield sse(event, item)
+        yield sse('done', {'success': True, 'data': cached})
+
+    async def stream():
+        result = None
+        started = time.perf_counter()
+        usage = {}
+        try:
+            for tier, model in enumerate(schematic_models()):
+                if tier:
+                    yield sse('escalated', {'model': model})
+                parser = SchematicStreamParser()
+                tier_started = time.perf_counter()
+                try:
+                    async with metrics.timed_async('trace_stage_seconds', stage='schematic'):
+                        async with client.messages.stream(**schematic_request(prompt, model)) as response:
+                            async for chunk in response.text_stream:
+                                for section, item in parser.feed(chunk):
+                                    yield sse(SCHEMATIC_EVENTS[section], item)
+                            message = await response.get_final_message()
+                    await asyncio.to_thread(log_usage, message, 'schematic')
+                    add_usage(usage, message)
+                except Exception as e:
+                    yield sse('done', {'success': False, 'error': str(e)})
+                    return
+
+                try:
+                    result = parser.result()
+                except Exception as e:
+                    error = e
+                await asyncio.to_thread(record_tier, 'schematic', model, result is not None,
+                                        time.perf_counter() - tier_started)
+                if result is not None:
+                    await asyncio.to_thread(keep_schematic, key, result, usage, time.perf_counter() - started)
+                    yield sse('done', {'success': True, 'data': result})
+                    return
+            yield sse('done', {'success': False, 'error': f'Parse error: {str(error)}, raw: {parser.text.strip()[:200]}'})
+        finally:
+            await metrics.inc_async('trace_runs_total', pipeline='schematic',
+                                    outcome='success' if result is not None else 'failure')
+            await asyncio.to_thread(schematic_cache.finish, key, result)
+
+    if cached is None:
+        await asyncio.to_thread(count_call, request)
+    return StreamingResponse(replay() if cached is not None else stream(), media_type='text/event-stream',
+                             headers=dict(STREAM_HEADERS, **{'X-Trace-Cache': source}))
+
+
+# counts requests from the moment they arrive until the last byte of the response (streams included).
+# the event loop is single threaded, so a plain int is enough
+class InflightLimit:
+    def __init__(self, app, limit):
+        self.app = app
+        self.limit = limit
+        self.inflight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        if self.inflight >= self.limit:
+            response = JSONResponse({'success': False, 'error': 'Server is busy right now, try again in a bit.'},
+                                    status_code=503, headers={'Retry-After': '5'})
+            return await response(scope, receive, send)
+        self.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inflight -= 1
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # pcb --version is cached for TRACE_PCB_VERSION_TTL, get the first call out of the way before requests need it
+    await asyncio.to_thread(pcb_version)
+    yield
+    await client.close()
+
+
+# the mounted Flask app does its own CORS, so only the async routes get the middleware
+def route(path, endpoint):
+    cors = Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    return Route(path, endpoint, methods=['POST', 'OPTIONS'], middleware=[cors])
+
+
+routes = [
+    route('/generate', generate),
+    route('/generate/stream', generate_stream),
+    route('/schematic', schematic),
+    route('/schematic/stream', schematic_stream),
+    Mount('/', app=WSGIMiddleware(flask_app.app)),
+]
+
+app = InflightLimit(Starlette(routes=routes, lifespan=lifespan), MAX_INFLIGHT)
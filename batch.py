@@ -0,0 +1,291 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import anthropic
+
+from agent import (load_datasheet, zener_steps, run_steps, zener_request, build_zener_code,
+                   attempt_mode, record_attempt, log_usage, tier_model, ZENER_TIERS)
+
+# Turns a whole folder of datasheets into .zen modules, e.g. overnight:
+#   python batch.py datasheets/ --out zen/
+#   python batch.py "vendors/**/*.pdf" --out zen/ --extract-workers 8 --llm-concurrency 6
+# extraction runs on a process pool and feeds the LLM/build stage as each pdf finishes, the LLM calls
+# run with bounded concurrency, and every build gets its own workspace (see build_zener_code).
+# writes <part>.zen for each part that compiles, in the same subfolders as the pdf, plus a JSONL report line
+# per part. parts that already have a .zen in the output folder get skipped, so a killed run can just be
+# started again.
+# with --message-batches, the LLM calls go through the Message Batches API instead (cheaper, slower):
+# one batch for every first attempt, builds in parallel, then one batch with repair prompts for the failures
+
+
+def find_datasheets(source):
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '**', '*.pdf'), recursive=True)
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(path for path in paths if path.lower().endswith('.pdf'))
+
+
+# the directory the paths are relative to: the folder itself, or the part of the glob before the first wildcard
+def source_root(source):
+    if os.path.isdir(source):
+        return source
+    return os.path.dirname(re.split(r'[*?[]', source, maxsplit=1)[0]) or '.'
+
+
+# output name per pdf: its path under the source root without the extension, so vendors/ti/datasheet.pdf and
+# vendors/st/datasheet.pdf become ti/datasheet and st/datasheet. names that would still land on the same .zen
+# (datasheet.pdf next to datasheet.PDF, or on a case-insensitive filesystem) get a short hash of the path
+def part_names(source, paths):
+    root = source_root(source)
+    names = {path: os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '/') for path in paths}
+    clashes = {}
+    for path, name in names.items():
+        clashes.setdefault(name.lower(), []).append(path)
+    for clashing in clashes.values():
+        if len(clashing) < 2:
+            continue
+        print(f"{len(clashing)} datasheets would all be {names[clashing[0]]}.zen, adding a hash to each: {', '.join(clashing)}")
+        for path in clashing:
+            names[path] += '-' + hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+    return names
+
+
+def zen_path(out_dir, part):
+    return os.path.join(out_dir, *part.split('/')) + '.zen'
+
+
+# every datasheet under source with its part name, and the paths that don't have a .zen in out_dir yet
+def pending_parts(source, out_dir):
+    paths = find_datasheets(source)
+    names = part_names(source, paths)
+    todo = [path for path in paths if not os.path.exists(zen_path(out_dir, names[path]))]
+    print(f'{len(paths)} datasheets, {len(paths) - len(todo)} already done, {len(todo)} to go')
+    return names, todo
+
+
+# runs in the process pool
+def extract_part(path):
+    start = time.perf_counter()
+    datasheet_text, pages = load_datasheet(path, workers=1)
+    return datasheet_text, pages, time.perf_counter() - start
+
+
+# generate -> build -> retry for one part, timing how long each stage took
+def generate_part(client, datasheet_text, max_attempts):
+    timings = {'generate': 0.0, 'build': 0.0, 'backoff': 0.0}
+    attempts = []
+    state = {'stage': None, 'since': time.perf_counter()}
+
+    def report(stage, attempt, **details):
+        now = time.perf_counter()
+        if state['stage'] in timings:
+            timings[state['stage']] += now - state['since']
+        state['stage'] = {'generating': 'generate', 'building': 'build', 'waiting': 'backoff'}.get(stage)
+        state['since'] = now
+        if stage == 'generating':
+            attempts.append({'attempt': attempt, 'mode': details.get('mode'), 'model': details.get('model')})
+        elif stage == 'build_failed':
+            attempts[-1]['errors'] = details['errors']
+
+    success, zen_code, errors = run_steps(zener_steps(client, datasheet_text, max_attempts, report))
+    report('done', len(attempts))
+    return success, zen_code, errors, attempts, timings
+
+
+def run_batch(source, out_dir, report_path=None, extract_workers=4, llm_concurrency=4, max_attempts=3):
+    os.makedirs(out_dir, exist_ok=True)
+    report_path = report_path or os.path.join(out_dir, 'report.jsonl')
+    report_lock = threading.Lock()
+
+    names, todo = pending_parts(source, out_dir)
+
+    client = anthropic.Anthropic()
+
+    def write_report(entry):
+        with report_lock, open(report_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def finish_part(path, extracted):
+        part = names[path]
+        entry = {'part': part, 'pdf': path, 'finished': time.time()}
+        try:
+            datasheet_text, pages, extract_time = extracted
+            entry.update(pages=pages, chars=len(datasheet_text))
+            start = time.perf_counter()
+            success, zen_code, errors, attempts, timings = generate_part(client, datasheet_text, max_attempts)
+            entry.update(success=success, attempts=attempts,
+                         timings=dict(timings, extract=extract_time, total=extract_time + time.perf_counter() - start))
+            if success:
+                write_zen(out_dir, part, zen_code)
+            else:
+                entry['error'] = errors
+        except Exception as e:
+            entry.update(success=False, error=f'{type(e).__name__}: {e}')
+        entry['finished'] = time.time()
+        write_report(entry)
+        print(f"{part}: {'ok' if entry['success'] else 'failed'}")
+        return entry['success']
+
+    with ProcessPoolExecutor(max_workers=extract_workers) as extract_pool, \
+            ThreadPoolExecutor(max_workers=llm_concurrency) as llm_pool:
+        extracting = {extract_pool.submit(extract_part, path): path for path in todo}
+        generating = []
+        for future in as_completed(extracting):
+            path = extracting[future]
+            try:
+                extracted = future.result()
+            except Exception as e:
+                write_report({'part': names[path], 'pdf': path, 'success': False,
+                              'error': f'extraction failed: {type(e).__name__}: {e}', 'finished': time.time()})
+                print(f'{names[path]}: extraction failed')
+                continue
+            generating.append(llm_pool.submit(finish_part, path, extracted))
+        succeeded = sum(1 for future in generating if future.result())
+
+    print(f'{succeeded}/{len(todo)} compiled, report in {report_path}')
+    return succeeded, len(todo)
+
+
+def write_zen(out_dir, part, zen_code):
+    # write then rename, a half written .zen would make the next run skip the part
+    target = zen_path(out_dir, part)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.tmp', 'w') as f:
+        f.write(zen_code)
+    os.replace(target + '.tmp', target)
+
+
+def wait_for_batch(client, batch_id, poll_interval):
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == 'ended':
+            return batch
+        counts = batch.request_counts
+        print(f'batch {batch_id}: {counts.processing} processing, {counts.succeeded} done')
+        time.sleep(poll_interval)
+
+
+def run_message_batches(source, out_dir, report_path=None, extract_workers=4, build_concurrency=4,
+                        max_attempts=3, poll_interval=30, client=None):
+    os.makedirs(out_dir, exist_ok=True)
+    report_path = report_path or os.path.join(out_dir, 'report.jsonl')
+
+    names, todo = pending_parts(source, out_dir)
+
+    client = client or anthropic.Anthropic()
+    report = open(report_path, 'a')
+    start = time.perf_counter()
+
+    # custom_ids have to be short and plain, so parts get numbered ids
+    parts = {}
+    with ProcessPoolExecutor(max_workers=extract_workers) as pool:
+        extracting = {pool.submit(extract_part, path): path for path in todo}
+        for future in as_completed(extracting):
+            path = extracting[future]
+            try:
+                datasheet_text, pages, extract_time = future.result()
+            except Exception as e:
+                report.write(json.dumps({'part': names[path], 'pdf': path, 'success': False,
+                                         'error': f'extraction failed: {type(e).__name__}: {e}', 'finished': time.time()}) + '\n')
+                continue
+            parts[f'part-{len(parts)}'] = {
+                'part': names[path], 'pdf': path, 'text': datasheet_text, 'pages': pages,
+                'extract': extract_time, 'code': None, 'errors': None, 'request': None, 'attempts': [], 'batches': [],
+            }
+
+    pending = dict(parts)
+    for attempt in range(1, max_attempts + 1):
+        if not pending:
+            break
+        model = tier_model(ZENER_TIERS, attempt)
+        # a request that didn't get an answer last round (errored, expired, canceled) goes in again unchanged
+        for part in pending.values():
+            if part['request'] is None:
+                part['request'] = {'mode': attempt_mode(attempt, part['code']), 'model': model,
+                                   'params': zener_request(part['text'], part['errors'], part['code'], model=model)}
+        requests = [{'custom_id': custom_id, 'params': part['request']['params']} for custom_id, part in pending.items()]
+        batch = client.messages.batches.create(requests=requests)
+        print(f'attempt {attempt}: submitted batch {batch.id} with {len(requests)} requests')
+        wait_for_batch(client, batch.id, poll_interval)
+
+        outputs = {}
+        result_types = {}
+        for entry in client.messages.batches.results(batch.id):
+            result_types[entry.custom_id] = entry.result.type
+            if entry.result.type == 'succeeded':
+                log_usage(entry.result.message, 'batch')
+                outputs[entry.custom_id] = entry.result.message.content[0].text
+        for custom_id, part in pending.items():
+            part['batches'].append(batch.id)
+            part['attempts'].append({'attempt': attempt, 'mode': part['request']['mode'],
+                                     'model': part['request']['model']})
+            if custom_id in outputs:
+                part['request'] = None
+            else:
+                # no module came back, so there's nothing new to build or repair. code and errors stay as they were
+                part['attempts'][-1]['result'] = result_types.get(custom_id, 'missing')
+
+        # every module that came back gets built at once, each in its own workspace
+        built = [custom_id for custom_id in pending if custom_id in outputs]
+        with ThreadPoolExecutor(max_workers=build_concurrency) as pool:
+            results = pool.map(build_zener_code, [outputs[custom_id] for custom_id in built])
+            for custom_id, (success, errors) in zip(built, results):
+                part = pending[custom_id]
+                record_attempt(part['attempts'][-1]['mode'], success)
+                part['code'] = outputs[custom_id]
+                part['errors'] = None if success else errors
+                if success:
+                    write_zen(out_dir, part['part'], part['code'])
+                    del pending[custom_id]
+                else:
+                    part['attempts'][-1]['errors'] = errors
+
+    for custom_id, part in parts.items():
+        success = custom_id not in pending
+        entry = {key: part[key] for key in ('part', 'pdf', 'pages', 'attempts', 'batches')}
+        entry.update(chars=len(part['text']), success=success, finished=time.time(),
+                     timings={'extract': part['extract'], 'total': time.perf_counter() - start})
+        if not success:
+            entry['error'] = part['errors'] or f"batch request {part['attempts'][-1].get('result', 'failed')}"
+        report.write(json.dumps(entry) + '\n')
+    report.close()
+
+    succeeded = len(parts) - len(pending)
+    print(f'{succeeded}/{len(todo)} compiled, report in {report_path}')
+    return succeeded, len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate .zen modules for a folder (or glob) of datasheets')
+    parser.add_argument('source', help='directory of pdfs or a glob like "datasheets/**/*.pdf"')
+    parser.add_argument('--out', default='zen_out', help='where the .zen files and report go')
+    parser.add_argument('--report', help='JSONL report path (default <out>/report.jsonl)')
+    parser.add_argument('--extract-workers', type=int, default=4)
+    parser.add_argument('--llm-concurrency', type=int, default=4)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--message-batches', action='store_true', help='use the Message Batches API (cheaper, slower)')
+    parser.add_argument('--poll-interval', type=float, default=30, help='seconds between batch status checks')
+    parser.add_argument('--replay', action='store_true',
+                        help='with --message-batches, answer from bench/replay.py instead of the API (for testing)')
+    parser.add_argument('--replay-failure-rate', type=float, default=0.0,
+                        help='with --replay, fraction of batch entries that come back errored/expired/canceled')
+    args = parser.parse_args()
+    if args.message_batches:
+        client = None
+        if args.replay:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+            from replay import ReplayClient
+            client = ReplayClient(first_token=0.05, batch_failure_rate=args.replay_failure_rate)
+        run_message_batches(args.source, args.out, args.report, args.extract_workers, args.llm_concurrency,
+                            args.max_attempts, args.poll_interval, client)
+    else:
+        run_batch(args.source, args.out, args.report, args.extract_workers, args.llm_concurrency, args.max_attempts)
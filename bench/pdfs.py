@@ -0,0 +1,84 @@
+import os
+import random
+
+# Synthetic datasheets for benchmarks, written by hand so there's no extra dependency.
+# pages cycle through the kinds of content a real datasheet has (pinouts, ratings,
+# application circuits, marketing, revision history) so page selection has something to rank
+
+PAGE_KINDS = [
+    ('Pin Configuration and Functions', ['Pin {n} GPIO{n} I/O General purpose input/output',
+                                         'Pin {n} VDD3P3 Power 3.3V supply, decouple with 100nF',
+                                         'Pin {n} EN Input Chip enable, active high']),
+    ('Absolute Maximum Ratings', ['Supply voltage VDD -0.3V to 3.6V',
+                                  'Input voltage on any pin -0.3V to VDD+0.3V',
+                                  'Storage temperature -40C to 150C']),
+    ('Typical Application Circuit', ['Place a 10uF bulk capacitor and 100nF decoupling capacitor on VDD',
+                                     'EN requires an RC delay of 10k and 1uF',
+                                     'Reference schematic for USB-UART programming']),
+    ('Product Overview', ['Industry leading low power wireless solution',
+                          'Ideal for smart home, wearables and IoT applications',
+                          'Contact your local sales office for pricing']),
+    ('Revision History', ['Rev 1.{n} Updated ordering information',
+                          'Rev 1.{n} Corrected typographical errors',
+                          'Rev 1.{n} Added disclaimer']),
+]
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _page_stream(number, rng):
+    title, lines = PAGE_KINDS[number % len(PAGE_KINDS)]
+    rows = [f'{title} (page {number + 1})']
+    for i in range(40):
+        rows.append(rng.choice(lines).format(n=rng.randint(0, 48)))
+    ops = ['BT', '/F1 10 Tf', '12 TL', '50 780 Td']
+    for row in rows:
+        ops.append(f'({_escape(row)}) Tj T*')
+    ops.append('ET')
+    return '\n'.join(ops).encode('latin-1')
+
+
+# writes a PDF with `pages` pages of text to path
+def make_pdf(path, pages, seed=0):
+    rng = random.Random(seed)
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    tree = add(None)
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    kids = []
+    for number in range(pages):
+        stream = _page_stream(number, rng)
+        content = add(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        kids.append(add(b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] '
+                        b'/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>' % (tree, font, content)))
+    objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % tree
+    objects[tree - 1] = (b'<< /Type /Pages /Count %d /Kids [' % pages
+                         + b' '.join(b'%d 0 R' % kid for kid in kids) + b'] >>')
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, catalog, xref)
+
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+
+def make_pdfs(directory, page_counts):
+    os.makedirs(directory, exist_ok=True)
+    return {pages: make_pdf(os.path.join(directory, f'datasheet_{pages}p.pdf'), pages, seed=pages)
+            for pages in page_counts}
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import itertools
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recorded_responses.json')
+
+
+# Stands in for anthropic.Anthropic() in benchmarks: replays recorded responses with a configurable
+# time-to-first-token and output speed, for both messages.create and messages.stream.
+# requests with the Zener spec as their system prompt get the recorded .zen modules, anything else
+# gets the recorded schematic answers
+class ReplayClient:
+    def __init__(self, path=RECORDED, first_token=0.2, tokens_per_second=2000, unique=True, batch_failure_rate=0.0):
+        with open(path) as f:
+            self.recorded = json.load(f)
+        self.first_token = first_token
+        self.tokens_per_second = tokens_per_second
+        self.unique = unique
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.batches = {}
+        # batch entries that come back errored / expired / canceled instead of succeeded: a fraction of them at
+        # random, plus any custom_id put in batch_failures (custom_id -> result type, used up once)
+        self.batch_failure_rate = batch_failure_rate
+        self.batch_failures = {}
+        self.messages = SimpleNamespace(create=self.create, stream=self.stream,
+                                        batches=ReplayBatches(self))
+
+    def _pick(self, kwargs):
+        kind = 'schematic' if kwargs.get('tools') else 'zener'
+        with self.lock:
+            self.calls += 1
+            number = next(self.counter)
+        response = self.recorded[kind][number % len(self.recorded[kind])]
+        text = response['text']
+        # a unique trailing comment per call keeps the build cache from hiding pcb build time
+        if kind == 'zener' and self.unique:
+            text += f'\n# replay {number}\n'
+        return text, response['usage']
+
+    def _message(self, text, usage):
+        return SimpleNamespace(
+            content=[SimpleNamespace(type='text', text=text)],
+            usage=SimpleNamespace(**usage),
+        )
+
+    def _duration(self, usage):
+        return self.first_token + usage['output_tokens'] / self.tokens_per_second
+
+    def create(self, **kwargs):
+        text, usage = self._pick(kwargs)
+        time.sleep(self._duration(usage))
+        return self._message(text, usage)
+
+    def stream(self, **kwargs):
+        text, usage = self._pick(kwargs)
+        return ReplayStream(self, text, usage)
+
+
+class ReplayStream:
+    def __init__(self, client, text, usage, chunk=32):
+        self.client = client
+        self.text = text
+        self.usage = usage
+        self.chunk = chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, trace):
+        return False
+
+    @property
+    def text_stream(self):
+        time.sleep(self.client.first_token)
+        pieces = [self.text[i:i + self.chunk] for i in range(0, len(self.text), self.chunk)]
+        per_piece = (self.usage['output_tokens'] / self.client.tokens_per_second) / max(len(pieces), 1)
+        for piece in pieces:
+            time.sleep(per_piece)
+            yield piece
+
+    def get_final_message(self):
+        return self.client._message(self.text, self.usage)
+
+
+# Local stand-in for messages.batches: create() answers every request with a replayed create() on a
+# background thread, retrieve() reports in_progress until they're all done, results() yields
+# the entries (not in submission order, like the real thing). see ReplayClient for entries that fail
+class ReplayBatches:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, requests):
+        with self.client.lock:
+            batch_id = f'msgbatch_replay_{len(self.client.batches) + 1}'
+            batch = {'requests': list(requests), 'results': [], 'ended': threading.Event()}
+            self.client.batches[batch_id] = batch
+
+        def process():
+            for request in batch['requests']:
+                with self.client.lock:
+                    failure = self.client.batch_failures.pop(request['custom_id'], None)
+                if failure is None and random.random() < self.client.batch_failure_rate:
+                    failure = random.choice(('errored', 'expired', 'canceled'))
+                if failure is not None:
+                    result = SimpleNamespace(type=failure)
+                else:
+                    result = SimpleNamespace(type='succeeded', message=self.client.create(**request['params']))
+                batch['results'].append(SimpleNamespace(custom_id=request['custom_id'], result=result))
+            batch['ended'].set()
+
+        threading.Thread(target=process, daemon=True).start()
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id):
+        batch = self.client.batches[batch_id]
+        types = [entry.result.type for entry in batch['results']]
+        ended = batch['ended'].is_set()
+        counts = SimpleNamespace(processing=len(batch['requests']) - len(types), succeeded=types.count('succeeded'),
+                                 errored=types.count('errored'), canceled=types.count('canceled'),
+                                 expired=types.count('expired'))
+        return SimpleNamespace(id=batch_id, processing_status='ended' if ended else 'in_progress',
+                               request_counts=counts)
+
+    def results(self, batch_id):
+        batch = self.client.batches[batch_id]
+        if not batch['ended'].is_set():
+            raise RuntimeError(f'batch {batch_id} is still processing')
+        return iter(reversed(batch['results']))
+
+
+# the same replay for AsyncAnthropic (asgi.py): waits with asyncio.sleep so calls overlap on one event loop
+class AsyncReplayClient(ReplayClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = SimpleNamespace(create=self.create, stream=self.stream)
+
+    async def create(self, **kwargs):
+        text, usage = self._pick(kwargs)
+        await asyncio.sleep(self._duration(usage))
+        return self._message(text, usage)
+
+    def stream(self, **kwargs):
+        text, usage = self._pick(kwargs)
+        return AsyncReplayStream(self, text, usage)
+
+    async def close(self):
+        pass
+
+
+class AsyncReplayStream(ReplayStream):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, kind, error, trace):
+        return False
+
+    @property
+    async def text_stream(self):
+        await asyncio.sleep(self.client.first_token)
+        pieces = [self.text[i:i + self.chunk] for i in range(0, len(self.text), self.chunk)]
+        per_piece = (self.usage['output_tokens'] / self.client.tokens_per_second) / max(len(pieces), 1)
+        for piece in pieces:
+            await asyncio.sleep(per_piece)
+            yield piece
+
+    async def get_final_message(self):
+        return self.client._message(self.text, self.usage)
@@ -0,0 +1,202 @@
+"""Offline benchmarks for trace, no API key or pcb toolchain needed.
+
+Replays recorded Anthropic responses (bench/recorded_responses.json), stubs `pcb build` with
+bench/fake_pcb/pcb and generates synthetic datasheets, then reports p50/p95 latency and
+requests per second for /generate and /schematic at each concurrency level, plus
+extract_pdf timings serial vs. sharded.
+
+    python bench/run.py
+    python bench/run.py --concurrency 1,4,16 --requests 32 --pages 10,80,300 --pcb-fail-rate 0.3
+    python bench/run.py --endpoints generate --pcb-fail-rate 0.5 --candidates 3
+    python bench/run.py --endpoints generate --pcb-cold-start 1 --build-workers 0
+    python bench/run.py --asgi --concurrency 1,16,64
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from pdfs import make_pdfs
+from replay import AsyncReplayClient, ReplayClient
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', default='generate,schematic')
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--requests', type=int, default=32, help='requests per endpoint and concurrency level')
+    parser.add_argument('--pages', default='10,80,300', help='synthetic datasheet page counts')
+    parser.add_argument('--llm-first-token', type=float, default=0.2, help='seconds before the first replayed token')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=2000)
+    parser.add_argument('--pcb-latency', type=float, default=0.5, help='seconds per fake pcb build')
+    parser.add_argument('--pcb-cold-start', type=float, default=0.0,
+                        help='extra seconds for the first fake build in a workspace')
+    parser.add_argument('--build-workers', type=int, default=4, help='TRACE_BUILD_WORKERS, 0 builds everything cold')
+    parser.add_argument('--pcb-fail-rate', type=float, default=0.0, help='fraction of fake builds that fail')
+    parser.add_argument('--backoff-base', type=float, default=0.0, help='TRACE_BACKOFF_BASE for the retry loop')
+    parser.add_argument('--candidates', type=int, default=1, help='TRACE_SPECULATIVE_CANDIDATES per attempt')
+    parser.add_argument('--cold-extract', action='store_true', help='disable the extracted text cache')
+    parser.add_argument('--repeat-prompts', action='store_true', help='send the same /schematic prompt every time')
+    parser.add_argument('--skip-extract', action='store_true', help="don't time extract_pdf on its own")
+    parser.add_argument('--extract-workers', default='1,4', help='worker counts for the extract_pdf timings')
+    parser.add_argument('--asgi', action='store_true',
+                        help='drive asgi.app (AsyncAnthropic, async pcb builds) instead of the Flask app')
+    return parser.parse_args()
+
+
+# has to happen before app / agent get imported, they read their settings at import time
+def configure(args, workdir):
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'fake_pcb') + os.pathsep + os.environ['PATH']
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'offline-benchmark')
+    os.environ['TRACE_STORE'] = 'memory://'
+    os.environ['TRACE_TEXT_CACHE_DIR'] = os.path.join(workdir, 'text_cache')
+    # the same synthetic pdfs get posted over and over, stored artifacts would answer all but the first
+    os.environ['TRACE_ARTIFACTS'] = 'off'
+    os.environ['TRACE_BACKOFF_BASE'] = str(args.backoff_base)
+    os.environ['TRACE_SPECULATIVE_CANDIDATES'] = str(args.candidates)
+    os.environ['TRACE_FAKE_PCB_LATENCY'] = str(args.pcb_latency)
+    os.environ['TRACE_FAKE_PCB_FAIL_RATE'] = str(args.pcb_fail_rate)
+    os.environ['TRACE_FAKE_PCB_COLD_START'] = str(args.pcb_cold_start)
+    os.environ['TRACE_BUILD_WORKERS'] = str(args.build_workers)
+    os.environ['TRACE_LOG_LEVEL'] = 'WARNING'
+    if args.cold_extract:
+        os.environ['TRACE_TEXT_CACHE_MAX_BYTES'] = '0'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def report(label, latencies, wall, failures):
+    print(f'{label:<40} n={len(latencies):<4} p50={statistics.median(latencies):7.3f}s '
+          f'p95={percentile(latencies, 0.95):7.3f}s rps={len(latencies) / wall:7.2f} failed={failures}')
+
+
+def run_load(flask_app, concurrency, count, make_request):
+    def one(i):
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        response = make_request(client, i)
+        ok = response.status_code == 200 and (response.get_json(silent=True) or {}).get('success', False)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(count)))
+    wall = time.perf_counter() - start
+    return [latency for latency, _ in results], wall, sum(1 for _, ok in results if not ok)
+
+
+# same as run_load, but against the ASGI app in this process: every request is a task on one event loop,
+# make_request gets an httpx.AsyncClient and returns the coroutine for the request
+def run_load_asgi(asgi_app, concurrency, count, make_request):
+    import httpx
+
+    async def load():
+        slots = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            async def one(i):
+                async with slots:
+                    start = time.perf_counter()
+                    response = await make_request(client, i)
+                    ok = response.status_code == 200 and response.json().get('success', False)
+                    return time.perf_counter() - start, ok
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(one(i) for i in range(count)))
+            return results, time.perf_counter() - start
+
+    results, wall = asyncio.run(load())
+    return [latency for latency, _ in results], wall, sum(1 for _, ok in results if not ok)
+
+
+def bench_extract(pdfs, workers):
+    import agent
+    print('\nextract_pdf')
+    for pages, path in sorted(pdfs.items()):
+        serial = None
+        for count in workers:
+            start = time.perf_counter()
+            text = agent.extract_pdf(path, workers=count)
+            elapsed = time.perf_counter() - start
+            same = '' if serial is None else ('  same text' if text == serial else '  TEXT DIFFERS')
+            serial = text if serial is None else serial
+            print(f'  {pages:>4} pages  workers={count:<3} {elapsed:7.3f}s{same}')
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='trace_bench_')
+    configure(args, workdir)
+
+    import app as trace_app
+
+    replay = ReplayClient(first_token=args.llm_first_token, tokens_per_second=args.llm_tokens_per_second)
+    trace_app.client = replay
+    if args.asgi:
+        import asgi
+        async_replay = AsyncReplayClient(first_token=args.llm_first_token, tokens_per_second=args.llm_tokens_per_second)
+        asgi.client = async_replay
+
+        def load(concurrency, make_request):
+            return run_load_asgi(asgi.app, concurrency, args.requests, make_request)
+    else:
+        def load(concurrency, make_request):
+            return run_load(trace_app.app, concurrency, args.requests, make_request)
+    pdfs = make_pdfs(os.path.join(workdir, 'pdfs'), [int(p) for p in args.pages.split(',')])
+    levels = [int(c) for c in args.concurrency.split(',')]
+    endpoints = args.endpoints.split(',')
+
+    if not args.skip_extract:
+        bench_extract(pdfs, [int(w) for w in args.extract_workers.split(',')])
+
+    if 'generate' in endpoints:
+        print('\n/generate')
+        for pages, path in sorted(pdfs.items()):
+            for concurrency in levels:
+                def make_request(client, i):
+                    if args.asgi:
+                        with open(path, 'rb') as f:
+                            upload = f.read()
+                        return client.post('/generate',
+                                           files={'file': (os.path.basename(path), upload, 'application/pdf')})
+                    with open(path, 'rb') as f:
+                        return client.post('/generate', data={'file': (f, os.path.basename(path))})
+                latencies, wall, failures = load(concurrency, make_request)
+                report(f'  {pages} pages, concurrency {concurrency}', latencies, wall, failures)
+
+    if 'schematic' in endpoints:
+        print('\n/schematic')
+        for concurrency in levels:
+            def make_request(client, i):
+                prompt = 'ESP32 with USB charging' if args.repeat_prompts else f'ESP32 with USB charging, variant {concurrency}-{i}'
+                return client.post('/schematic', json={'prompt': prompt})
+            latencies, wall, failures = load(concurrency, make_request)
+            report(f'  concurrency {concurrency}', latencies, wall, failures)
+
+    import agent
+    stats = agent.BUILD_WORKERS.stats
+    if stats['warmed']:
+        print(f"\nbuild workspaces: {stats['warm']} warm builds, {stats['cold']} cold, "
+              f"{stats['warmed']} warmed in {stats['warmup_seconds']:.1f}s total")
+    if args.candidates > 1:
+        stats = agent.SPECULATION_STATS
+        print(f"\nspeculation: {stats['wins']}/{stats['races']} races compiled, ~{stats['saved_seconds']:.1f}s saved "
+              f"for ~{stats['extra_output_tokens']} extra output tokens")
+    calls = replay.calls + (async_replay.calls if args.asgi else 0)
+    print(f'\n{calls} replayed LLM calls, scratch files in {workdir}')
+
+
+if __name__ == '__main__':
+    main()
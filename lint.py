@@ -0,0 +1,124 @@
+import re
+
+# Quick checks on model output before it goes anywhere near `pcb build`. only things that are broken for
+# sure: markdown fences, unbalanced brackets, Power() without a voltage (the spec insists) and load() /
+# Module() paths that can't exist in the build workspace. anything subtler is left to the compiler.
+# diagnostics are dicts with file, line, col, severity, code and message
+
+_PAIRS = {'(': ')', '[': ']', '{': '}'}
+_CALL = re.compile(r'(?<![\w.])(Power|load|Module)\s*\(')
+# aliases and remote hosts pcb resolves on its own, anything else has to be a file next to the module
+_REMOTE_PREFIXES = ('@', 'github.com/', 'gitlab.com/', 'package://', 'http://', 'https://')
+
+
+def diagnostic(filename, line, col, code, message, severity='error'):
+    return {'file': filename, 'line': line, 'col': col, 'severity': severity, 'code': code, 'message': message}
+
+
+# the code with every string and comment blanked out (same length, newlines kept), so the checks below
+# don't trip over brackets or "Power(" inside them. also returns where each string literal starts and its value
+def _mask(code):
+    masked = list(code)
+    strings = {}
+    i = 0
+    while i < len(code):
+        ch = code[i]
+        if ch == '#':
+            end = code.find('\n', i)
+            end = len(code) if end == -1 else end
+        elif ch in '"\'':
+            quote = code[i:i + 3] if code[i:i + 3] in ('"""', "'''") else ch
+            end = i + len(quote)
+            while end < len(code) and not code.startswith(quote, end):
+                if code[end] == '\\':
+                    end += 1
+                elif code[end] == '\n' and len(quote) == 1:
+                    break
+                end += 1
+            end = min(end + len(quote), len(code))
+            strings[i] = code[i + len(quote):end - len(quote)]
+        else:
+            i += 1
+            continue
+        for j in range(i, end):
+            if masked[j] != '\n':
+                masked[j] = ' '
+        i = end
+    return ''.join(masked), strings
+
+
+def _position(code, offset):
+    line = code.count('\n', 0, offset) + 1
+    return line, offset - (code.rfind('\n', 0, offset) + 1) + 1
+
+
+def lint_zen(zen_code, filename='output.zen'):
+    found = []
+
+    for number, line in enumerate(zen_code.split('\n'), 1):
+        if line.lstrip().startswith('```'):
+            found.append(diagnostic(filename, number, line.index('`') + 1, 'markdown-fence',
+                                    'markdown code fence, output has to be bare Zener code'))
+
+    masked, strings = _mask(zen_code)
+
+    stack = []
+    for offset, ch in enumerate(masked):
+        if ch in _PAIRS:
+            stack.append((ch, offset))
+        elif ch in _PAIRS.values():
+            if stack and _PAIRS[stack[-1][0]] == ch:
+                stack.pop()
+            else:
+                found.append(diagnostic(filename, *_position(zen_code, offset), 'unbalanced-delimiter',
+                                        f"unexpected '{ch}'"))
+                break
+    else:
+        for opener, offset in stack[:1]:
+            found.append(diagnostic(filename, *_position(zen_code, offset), 'unbalanced-delimiter',
+                                    f"'{opener}' is never closed"))
+
+    for match in _CALL.finditer(masked):
+        name, start = match.group(1), match.end()
+        line, col = _position(zen_code, match.start())
+        if name == 'Power':
+            end = _closing(masked, start - 1)
+            args = masked[start:end]
+            if not re.search(r'(?<![\w.])voltage\s*=', args):
+                found.append(diagnostic(filename, line, col, 'power-without-voltage',
+                                        'Power() needs voltage=, e.g. Power("VDD", voltage=Voltage("3.3V"))'))
+            elif re.search(r'(?<![\w.])voltage\s*=\s*None\b', args):
+                found.append(diagnostic(filename, line, col, 'power-without-voltage',
+                                        'Power() voltage can\'t be None, give an explicit Voltage'))
+            continue
+
+        rest = zen_code[start:]
+        path = strings.get(start + len(rest) - len(rest.lstrip()))
+        if path is None:
+            continue
+        if name == 'load' and not path.endswith('.zen'):
+            found.append(diagnostic(filename, line, col, 'bad-load-path', f'load() path "{path}" isn\'t a .zen file'))
+        elif not path.startswith(_REMOTE_PREFIXES) and path.lstrip('./') != filename:
+            found.append(diagnostic(filename, line, col, 'bad-load-path',
+                                    f'{name}() path "{path}" doesn\'t exist, the module is built on its own. '
+                                    'use @stdlib or a package URL'))
+    return found
+
+
+# index of the bracket that closes the one at masked[start], or the end of the text
+def _closing(masked, start):
+    depth = 0
+    for offset in range(start, len(masked)):
+        if masked[offset] in _PAIRS:
+            depth += 1
+        elif masked[offset] in _PAIRS.values():
+            depth -= 1
+            if depth == 0:
+                return offset
+    return len(masked)
+
+
+# diagnostics in the same shape pcb prints them, so the repair prompt and the UI don't care which one found it
+def format_diagnostics(diagnostics):
+    return ''.join(f"{d['severity']}[{d['code']}]: {d['message']}\n  --> {d['file']}:{d['line']}:{d['col']}\n"
+                   for d in diagnostics)
@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import os
+import re
+import time
+
+from store import STORE
+
+# Prometheus-style counters and histograms for the pipeline. they're kept as counters in the shared store,
+# so /metrics on any gunicorn worker reports the whole deployment. with TRACE_METRICS off (the default)
+# every call here returns straight away and nothing gets written
+METRICS_ENABLED = os.environ.get('TRACE_METRICS', '0') == '1'
+
+# seconds, LLM calls and builds are slow so the buckets go up to minutes
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = {
+    'trace_stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'trace_request_seconds': ('histogram', 'End to end time per endpoint'),
+    'trace_tokens_total': ('counter', 'Anthropic tokens used, by endpoint and kind'),
+    'trace_attempts_total': ('counter', 'Zener attempts by mode and build outcome'),
+    'trace_runs_total': ('counter', 'Finished runs by pipeline and outcome'),
+    'trace_build_cache_total': ('counter', 'pcb build cache lookups by result'),
+    'trace_build_seconds': ('histogram', 'pcb build time by workspace (warm, cold)'),
+    'trace_build_warmup_seconds': ('histogram', 'Time to warm a build workspace, the cold start warm builds skip'),
+    'trace_diagnostics_total': ('counter', 'Errors in failed builds, by kind (diagnostic code or message pattern)'),
+    'trace_lint_total': ('counter', 'Modules linted before pcb build, by result (passed, rejected)'),
+    'trace_schematic_cache_total': ('counter', '/schematic cache lookups by result (hit, shared, artifact, miss)'),
+    'trace_tier_attempts_total': ('counter', 'Attempts per model tier by pipeline and outcome'),
+    'trace_tier_seconds': ('histogram', 'Time per attempt for each model tier (zener: generate + build)'),
+    'trace_speculation_races_total': ('counter', 'Speculative candidate races by outcome'),
+    'trace_speculation_saved_seconds_total': ('counter', 'Estimated seconds saved by speculative candidates'),
+    'trace_speculation_extra_tokens_total': ('counter', 'Estimated output tokens spent on candidates that were not kept'),
+}
+
+PREFIX = 'metric:'
+FOREVER = 10 * 365 * 24 * 3600
+
+
+# key="value" pairs of a stored series, value still escaped and quoted
+_LABEL = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*")')
+
+
+# label values as the exposition format wants them: backslash, double quote and newline escaped
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+def inc(name, amount=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    STORE.incr(PREFIX + _series(name, labels), FOREVER, amount)
+
+
+def observe(name, value, **labels):
+    if not METRICS_ENABLED:
+        return
+    bucket = next((str(le) for le in BUCKETS if value <= le), '+Inf')
+    STORE.incr(PREFIX + _series(name + '_bucket', dict(labels, le=bucket)), FOREVER)
+    STORE.incr(PREFIX + _series(name + '_sum', labels), FOREVER, value)
+    STORE.incr(PREFIX + _series(name + '_count', labels), FOREVER)
+
+
+# with timed('trace_stage_seconds', stage='build'): ...
+@contextlib.contextmanager
+def timed(name, **labels):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# the same for async code (asgi.py and the async pipeline). the store can be sqlite, so the writes go to a
+# thread instead of holding up the event loop, and with metrics off they don't go anywhere
+async def inc_async(name, amount=1, **labels):
+    if METRICS_ENABLED:
+        await asyncio.to_thread(inc, name, amount, **labels)
+
+
+async def observe_async(name, value, **labels):
+    if METRICS_ENABLED:
+        await asyncio.to_thread(observe, name, value, **labels)
+
+
+# async with timed_async('trace_stage_seconds', stage='generate'): ...
+@contextlib.asynccontextmanager
+async def timed_async(name, **labels):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        await observe_async(name, time.perf_counter() - start, **labels)
+
+
+# input/output/cache token counts off an anthropic response
+def record_usage(message, endpoint):
+    usage = getattr(message, 'usage', None)
+    if not METRICS_ENABLED or usage is None:
+        return
+    for kind, field in (('input', 'input_tokens'), ('output', 'output_tokens'),
+                        ('cache_read', 'cache_read_input_tokens'), ('cache_write', 'cache_creation_input_tokens')):
+        count = getattr(usage, field, 0) or 0
+        if count:
+            inc('trace_tokens_total', count, endpoint=endpoint, kind=kind)
+
+
+# the text exposition format. stored buckets are per bucket, prometheus wants them cumulative
+def render():
+    values = {key[len(PREFIX):]: value for key, value in STORE.counters(PREFIX).items()}
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for series in sorted(values):
+                if series == name or series.startswith(name + '{'):
+                    lines.append(f'{series} {values[series]}')
+            continue
+
+        buckets = {}
+        for series, value in values.items():
+            if not series.startswith(name + '_bucket{'):
+                continue
+            labels = dict(_LABEL.findall(series[len(name) + 8:-1]))
+            le = labels.pop('le').strip('"')
+            base = ','.join(f'{key}={value}' for key, value in sorted(labels.items()))
+            buckets.setdefault(base, {})[le] = value
+        for base, counts in sorted(buckets.items()):
+            total = 0
+            for le in [str(le) for le in BUCKETS] + ['+Inf']:
+                total += counts.get(le, 0)
+                labels = f'{base},le="{le}"' if base else f'le="{le}"'
+                lines.append(f'{name}_bucket{{{labels}}} {total}')
+            suffix = '{' + base + '}' if base else ''
+            lines.append(f'{name}_sum{suffix} {values.get(name + "_sum" + suffix, 0)}')
+            lines.append(f'{name}_count{suffix} {values.get(name + "_count" + suffix, 0)}')
+    return '\n'.join(lines) + '\n'
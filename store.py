@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Shared state for every gunicorn worker (and the CLI) without running redis or anything else.
+# TRACE_STORE is either sqlite:///path/to/file.db (the default, shared across processes)
+# or memory:// (per process, what we had before)
+DEFAULT_STORE_URI = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'trace_store.sqlite3')
+STORE_URI = os.environ.get('TRACE_STORE', DEFAULT_STORE_URI)
+
+
+# key/value entries live in namespaces (one per cache), each with an optional expiry and a last-used time
+# for LRU eviction. counters (value + window expiry) are separate, the rate limiter and metrics keep theirs there
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().db.execute('PRAGMA journal_mode=WAL') # readers don't block the writer
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT, key TEXT, value TEXT, expires REAL, used REAL,
+                PRIMARY KEY (namespace, key))''')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (namespace, used)')
+            db.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER, expires REAL)')
+
+    def connect(self):
+        return thread_connection(self.local, self.path)
+
+    def get(self, namespace, key, default=None):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute('SELECT value, expires FROM entries WHERE namespace=? AND key=?',
+                             (namespace, key)).fetchone()
+            if row is None:
+                return default
+            if row[1] is not None and row[1] <= now:
+                db.execute('DELETE FROM entries WHERE namespace=? AND key=?', (namespace, key))
+                return default
+            db.execute('UPDATE entries SET used=? WHERE namespace=? AND key=?', (now, namespace, key))
+        return json.loads(row[0])
+
+    # max_entries evicts the least recently used entries in the namespace past that count
+    def set(self, namespace, key, value, ttl=None, max_entries=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                       (namespace, key, json.dumps(value), expires, now))
+            if max_entries is not None:
+                db.execute('''DELETE FROM entries WHERE namespace=? AND key IN (
+                    SELECT key FROM entries WHERE namespace=? ORDER BY used DESC LIMIT -1 OFFSET ?)''',
+                           (namespace, namespace, max_entries))
+
+    # set, but only if the key isn't there already (or has expired). returns whether we got it
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self.connect() as db:
+            db.execute('DELETE FROM entries WHERE namespace=? AND key=? AND expires<=?', (namespace, key, now))
+            cursor = db.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                (namespace, key, json.dumps(value), expires, now))
+            return cursor.rowcount == 1
+
+    def delete(self, namespace, key):
+        with self.connect() as db:
+            db.execute('DELETE FROM entries WHERE namespace=? AND key=?', (namespace, key))
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute('SELECT value, expires FROM counters WHERE key=?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires = amount, now + expiry
+            else:
+                value, expires = row[0] + amount, row[1]
+            db.execute('INSERT OR REPLACE INTO counters VALUES (?, ?, ?)', (key, value, expires))
+        return value
+
+    # (value, expires) for a counter, (0, None) if it isn't running
+    def counter(self, key):
+        with self.connect() as db:
+            row = db.execute('SELECT value, expires FROM counters WHERE key=?', (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return 0, None
+        return row[0], row[1]
+
+    # every live counter whose key starts with prefix, as {key: value}
+    def counters(self, prefix):
+        with self.connect() as db:
+            rows = db.execute('SELECT key, value FROM counters WHERE key >= ? AND key < ? AND expires > ?',
+                              (prefix, prefix + '\uffff', time.time())).fetchall()
+        return dict(rows)
+
+    def clear_counter(self, key):
+        with self.connect() as db:
+            db.execute('DELETE FROM counters WHERE key=?', (key,))
+
+    def reset_counters(self, prefix=''):
+        with self.connect() as db:
+            return db.execute('DELETE FROM counters WHERE key >= ? AND key < ?', (prefix, prefix + '\uffff')).rowcount
+
+
+# one connection per thread per process, sqlite connections can't cross either.
+# local is a threading.local() owned by whoever keeps the connections
+def thread_connection(local, path):
+    db = getattr(local, 'db', None)
+    if db is None or local.pid != os.getpid():
+        db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA busy_timeout=30000')
+        local.db = db
+        local.pid = os.getpid()
+    return Transaction(db)
+
+
+# BEGIN IMMEDIATE takes the write lock up front, so read-modify-write (incr, add) is atomic across processes
+class Transaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, kind, error, trace):
+        self.db.execute('ROLLBACK' if kind else 'COMMIT')
+
+
+# same interface as SQLiteStore, kept in a dict, for when sharing isn't wanted
+class MemoryStore:
+    def __init__(self):
+        self.entries = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def _live(self, namespace, key, now):
+        entry = self.entries.get((namespace, key))
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.entries[(namespace, key)]
+            return None
+        return entry
+
+    def get(self, namespace, key, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self._live(namespace, key, now)
+            if entry is None:
+                return default
+            entry[2] = now
+            return json.loads(entry[0])
+
+    def set(self, namespace, key, value, ttl=None, max_entries=None):
+        now = time.time()
+        with self.lock:
+            self.entries[(namespace, key)] = [json.dumps(value), now + ttl if ttl is not None else None, now]
+            if max_entries is not None:
+                keys = sorted((k for k in self.entries if k[0] == namespace), key=lambda k: self.entries[k][2])
+                for k in keys[:max(len(keys) - max_entries, 0)]:
+                    del self.entries[k]
+
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            if self._live(namespace, key, now) is not None:
+                return False
+            self.entries[(namespace, key)] = [json.dumps(value), now + ttl if ttl is not None else None, now]
+            return True
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self.lock:
+            value, expires = self.counts.get(key, (0, 0))
+            if expires <= now:
+                value, expires = 0, now + expiry
+            self.counts[key] = (value + amount, expires)
+            return value + amount
+
+    def counter(self, key):
+        with self.lock:
+            value, expires = self.counts.get(key, (0, 0))
+        if expires <= time.time():
+            return 0, None
+        return value, expires
+
+    def counters(self, prefix):
+        now = time.time()
+        with self.lock:
+            return {key: value for key, (value, expires) in self.counts.items()
+                    if key.startswith(prefix) and expires > now}
+
+    def clear_counter(self, key):
+        with self.lock:
+            self.counts.pop(key, None)
+
+    def reset_counters(self, prefix=''):
+        with self.lock:
+            keys = [key for key in self.counts if key.startswith(prefix)]
+            for key in keys:
+                del self.counts[key]
+        return len(keys)
+
+
+def open_store(uri):
+    if uri.startswith('sqlite://'):
+        return SQLiteStore(uri[len('sqlite://'):])
+    if uri.startswith('memory://'):
+        return MemoryStore()
+    raise ValueError(f'Unknown TRACE_STORE {uri!r}, use sqlite:///path or memory://')
+
+
+STORE = open_store(STORE_URI)
@@ -0,0 +1,137 @@
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Warm build workspaces for `pcb build`. pcb has no server mode to keep running and feed builds to, so the
+# warm state we can hold on to is the workspace: each one gets a throwaway build of WARMUP_ZEN when it's
+# created, which resolves and caches @stdlib (and whatever else pcb sets up on a first build) right there.
+# a real build borrows an idle workspace, and whatever it added gets deleted before it goes back.
+# when none is idle (still warming, or more builds than workspaces) the build gets a fresh temp dir like before.
+# warm-up time is kept apart from build time: trace_build_warmup_seconds vs trace_build_seconds{workspace=...}
+
+# what the spec and the usual outputs load, so the first real build finds it resolved
+WARMUP_ZEN = '''load("@stdlib/units.zen", "Voltage", "Resistance", "Capacitance")
+load("@stdlib/interfaces.zen", "Power", "Ground")
+
+Resistor = Module("@stdlib/generics/Resistor.zen")
+Capacitor = Module("@stdlib/generics/Capacitor.zen")
+
+vdd = io("VDD", Power, default=Power("VDD", voltage=Voltage("3.3V")))
+gnd = io("GND", Ground)
+
+Capacitor(name="C1", value="100nF", P1=vdd.NET, P2=gnd.NET)
+'''
+WARMUP_TIMEOUT = 300
+
+
+class BuildWorkers:
+    def __init__(self, count, filename='output.zen'):
+        self.count = count
+        self.filename = filename
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        # the entries a warm workspace had right after warming, anything else is left over from a build
+        self.baseline = {}
+        self.stats = {'warm': 0, 'cold': 0, 'warmed': 0, 'warmup_seconds': 0.0}
+        atexit.register(self.close)
+
+    # warms every workspace in the background, calling it again is a no-op. keyed on the pid because a
+    # gunicorn --preload fork copies the started flag but not the threads doing the warming.
+    # without pcb there's nothing to warm, every build gets a fresh temp dir (and fails the way it always did)
+    def start(self):
+        with self.lock:
+            if self.count <= 0 or self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.idle = queue.Queue()
+            self.baseline = {}
+            if shutil.which('pcb') is None:
+                log.info('pcb is not on the PATH, not warming build workspaces')
+                return
+        for _ in range(self.count):
+            threading.Thread(target=self._warm, daemon=True).start()
+
+    def _warm(self):
+        workspace = tempfile.mkdtemp(prefix='trace_worker_')
+        path = os.path.join(workspace, self.filename)
+        with open(path, 'w') as f:
+            f.write(WARMUP_ZEN)
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(["pcb", "build", self.filename], capture_output = True, text = True,
+                                    cwd = workspace, timeout = WARMUP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            # no pcb (or a stuck one), builds will just keep using fresh temp dirs
+            log.warning('could not warm a build workspace: %s', e)
+            shutil.rmtree(workspace, ignore_errors=True)
+            return
+        seconds = time.perf_counter() - start
+        if result.returncode != 0:
+            # the packages still got resolved, that's the part that matters
+            log.info('warm-up build failed: %s', result.stderr.strip()[:200])
+        os.remove(path)
+        with self.lock:
+            self.baseline[workspace] = set(os.listdir(workspace))
+            self.stats['warmed'] += 1
+            self.stats['warmup_seconds'] += seconds
+        metrics.observe('trace_build_warmup_seconds', seconds)
+        log.info('build workspace warmed in %.2fs', seconds)
+        self.idle.put(workspace)
+
+    # with BUILD_WORKERS.workspace() as (workspace, warm): write the module there and run pcb in it.
+    # the caller times the build into trace_build_seconds{workspace=warm|cold}, sync or async as it needs
+    @contextlib.contextmanager
+    def workspace(self):
+        self.start()
+        try:
+            workspace = self.idle.get_nowait()
+        except queue.Empty:
+            workspace = None
+        with self.lock:
+            self.stats['cold' if workspace is None else 'warm'] += 1
+        if workspace is None:
+            with tempfile.TemporaryDirectory(prefix='trace_build_') as workspace:
+                yield workspace, False
+            return
+        try:
+            yield workspace, True
+        finally:
+            self._release(workspace)
+
+    def _release(self, workspace):
+        keep = self.baseline.get(workspace)
+        try:
+            for entry in os.listdir(workspace):
+                if entry in keep:
+                    continue
+                path = os.path.join(workspace, entry)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        except (OSError, TypeError) as e:
+            # something cleaned up under us (tmp reaper, a fork that reset the pool), drop the workspace
+            log.warning('dropping build workspace %s: %s', workspace, e)
+            shutil.rmtree(workspace, ignore_errors=True)
+            return
+        self.idle.put(workspace)
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            workspaces = list(self.baseline)
+        for workspace in workspaces:
+            shutil.rmtree(workspace, ignore_errors=True)